@@ -0,0 +1,129 @@
+# channel_cache.py
+
+"""
+Persistent on-disk cache of decoded ConfocalFile channels.
+
+Each cached file gets its own entry directory, named by a hash of the source file's
+path, modification time and size (plus the decoded slice range), holding:
+    meta.json           scale and size metadata
+    channel_<n>.npy     decoded 8-bit channel n, loaded memory-mapped
+
+Entries are evicted least-recently-used first once the cache grows past its size cap.
+"""
+
+from hashlib import sha1
+import json
+import numpy as np
+import os
+import shutil
+from typing import Dict, Optional
+
+class ChannelCache(object):
+    """
+    A directory of decoded channels shared by all ConfocalFile objects that use it.
+    """
+
+    metaName = "meta.json"
+
+    def __init__(self, cacheDir: str, maxBytes: int = 20 * 1024**3):
+        self._cacheDir = os.path.abspath(os.path.expanduser(cacheDir))
+        self._maxBytes = maxBytes
+        os.makedirs(self._cacheDir, exist_ok=True)
+
+    def key(self, filepath: str, firstSlice: int, lastSlice: int) -> str:
+        """
+        Return the cache key for a file, which changes whenever the file is modified.
+        """
+        path = os.path.abspath(filepath)
+        stat = os.stat(path)
+        return sha1(f"{path}|{stat.st_mtime_ns}|{stat.st_size}|{firstSlice}|{lastSlice}".encode()).hexdigest()
+
+    def _entryDir(self, key: str) -> str:
+        return os.path.join(self._cacheDir, key)
+
+    def _channelPath(self, key: str, channel: int) -> str:
+        return os.path.join(self._entryDir(key), f"channel_{channel}.npy")
+
+    def _touch(self, key: str) -> None:
+        # the meta file's mtime records when the entry was last used
+        try:
+            os.utime(os.path.join(self._entryDir(key), self.metaName))
+        except OSError:
+            pass
+
+    def loadMeta(self, key: str) -> Optional[Dict]:
+        """
+        Return the metadata stored for key, or None if it isn't cached.
+        """
+        try:
+            with open(os.path.join(self._entryDir(key), self.metaName), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._touch(key)
+        return meta
+
+    def storeMeta(self, key: str, meta: Dict) -> None:
+        entryDir = self._entryDir(key)
+        os.makedirs(entryDir, exist_ok=True)
+        tmpPath = os.path.join(entryDir, f"{self.metaName}.{os.getpid()}.tmp")
+        with open(tmpPath, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmpPath, os.path.join(entryDir, self.metaName))
+
+    def loadChannel(self, key: str, channel: int) -> Optional[np.ndarray]:
+        """
+        Return the cached channel as a copy-on-write memory map, or None if it isn't cached.
+        """
+        try:
+            data = np.load(self._channelPath(key, channel), mmap_mode='c')
+        except (OSError, ValueError):
+            return None
+        self._touch(key)
+        return data
+
+    def storeChannel(self, key: str, channel: int, data: np.ndarray) -> None:
+        """
+        Save a decoded channel, then evict old entries if the cache is over its cap.
+        Files are written under a temporary name and renamed, so concurrent readers
+        never see a partial file.
+        """
+        path = self._channelPath(key, channel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = f"{path}.{os.getpid()}.tmp"
+        with open(tmpPath, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmpPath, path)
+        self._touch(key)
+        self.evict(keep=key)
+
+    def evict(self, keep: str = None) -> None:
+        """
+        Remove least recently used entries until the cache fits in maxBytes.
+        The entry named keep is never removed.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self._cacheDir):
+            entryDir = self._entryDir(key)
+            if not os.path.isdir(entryDir):
+                continue
+            size = 0
+            for name in os.listdir(entryDir):
+                try:
+                    size += os.path.getsize(os.path.join(entryDir, name))
+                except OSError:
+                    pass
+            try:
+                lastUsed = os.path.getmtime(os.path.join(entryDir, self.metaName))
+            except OSError:
+                lastUsed = 0.
+            entries.append((lastUsed, key, size))
+            total += size
+        for lastUsed, key, size in sorted(entries):
+            if total <= self._maxBytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entryDir(key), ignore_errors=True)
+            total -= size
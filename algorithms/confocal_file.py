@@ -10,12 +10,70 @@ Results:
     TODO: describe results
 """
 
+from algorithms.channel_cache import ChannelCache
+from concurrent.futures import ThreadPoolExecutor
 from czifile import CziFile
+from sysresources import availableCpus
 import numpy as np
+from typing import Dict, Tuple
+
+def minMax(img: np.ndarray, chunkBytes: int = 1 << 18) -> Tuple:
+    """
+    Return the min and max of img, reading it from memory once: it is taken in chunks
+    of rows of about chunkBytes, each still in cache when its max follows its min.
+    """
+    rowBytes = max(1, img[0].nbytes) if img.ndim > 1 else img.itemsize
+    rows = max(1, chunkBytes // rowBytes)
+    mymin = None
+    mymax = None
+    for start in range(0, img.shape[0], rows):
+        chunk = img[start:start + rows]
+        chunkMin = chunk.min()
+        chunkMax = chunk.max()
+        mymin = chunkMin if mymin is None else min(mymin, chunkMin)
+        mymax = chunkMax if mymax is None else max(mymax, chunkMax)
+    return mymin, mymax
+
+def to8bit(img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Min-max normalize img to the range 0-255 as uint8, one slice at a time.
+
+    The global min and max are gathered in a single pass over the slices, and each
+    slice is then converted in float32 and written into out (allocated if not given),
+    so peak memory is one float32 slice rather than several copies of the volume.
+    The result is identical to converting the whole volume at once.
+    """
+    if out is None:
+        out = np.empty(img.shape, dtype=np.uint8)
+    mymin = None
+    mymax = None
+    for imgSlice in img:
+        sliceMin, sliceMax = minMax(imgSlice)
+        mymin = sliceMin if mymin is None else min(mymin, sliceMin)
+        mymax = sliceMax if mymax is None else max(mymax, sliceMax)
+    mymin = np.float32(mymin)
+    mymax = np.float32(mymax)
+    for z, imgSlice in enumerate(img):
+        out[z] = ((imgSlice.astype(np.float32) - mymin) / (mymax - mymin) * 255.).astype(np.uint8)
+    return out
 
 class ConfocalFile(object):
     """
     Object representing a .czi file from the Stathopoulos lab's Zeiss confocal microcscope
+
+    firstSlice and lastSlice restrict the file to a range of Z slices, using the same
+    convention as the processing steps: lastSlice is inclusive, and negative values count
+    back from the last slice (-1 is the last slice).  Only the subblocks covering that
+    range are decoded, one channel at a time, and the 8-bit conversion is normalized over
+    that range alone.
+    Slice 0 of every channel_*() array is then slice firstSlice of the file.
+
+    If a ChannelCache is given, decoded channels and metadata are saved to it, and
+    reopening an unchanged file loads them memory-mapped instead of decoding again.
+
+    Compressed subblocks are decoded by a pool of maxWorkers threads (by default half
+    the available CPUs, within any container limit) straight into the preallocated
+    output array.  maxWorkers=1 decodes serially.
     """
 
     CHANNEL_647 = 0
@@ -23,52 +81,154 @@ class ConfocalFile(object):
     CHANNEL_488 = 2
     CHANNEL_NUCLEUS = 3
 
-    def __init__(self, filepath: str):
-        def to8bit(img):
-            asfloat = img.astype(np.float32)
-            mymin = np.min(asfloat)
-            mymax = np.max(asfloat)
-            return ((asfloat - mymin) / (mymax - mymin) * 255.).astype(np.uint8)
-        
-        _path = filepath
-        czi = CziFile(filepath)
-        meta = czi.metadata(raw=False)
+    def __init__(self, filepath: str, firstSlice: int = 0, lastSlice: int = -1, cache: ChannelCache = None,
+                 maxWorkers: int = None):
+        self._path = filepath
+        self._maxWorkers = max(1, availableCpus() // 2) if maxWorkers is None else max(1, maxWorkers)
+        self._cache = cache
+        self._cacheKey = cache.key(filepath, firstSlice, lastSlice) if cache else None
+        self._channelData: Dict[int, np.ndarray] = {}
+        # the file is kept open while the channels are decoded one at a time
+        self._czi = None
+        meta = cache.loadMeta(self._cacheKey) if cache else None
+        if meta is None:
+            meta = self._readMetadata()
+            if cache:
+                cache.storeMeta(self._cacheKey, meta)
+        self._scale = meta['scale']
+        self._sizeX = meta['sizeX']
+        self._sizeY = meta['sizeY']
+        self._sizeZ = meta['sizeZ']
+        self._channels = meta['channels']
+        self._convert8bit = meta['convert8bit']
+        self._firstSlice = max(0, min(self._sizeZ, firstSlice))
+        self._lastSlice = min(self._sizeZ, self._sizeZ + lastSlice + 1 if lastSlice < 0 else lastSlice) - 1
+        if cache or self._firstSlice > 0 or self._lastSlice < self._sizeZ - 1:
+            assert self._channels == 4
+            for channel in range(self._channels):
+                self._channel(channel)
+            return
+        image = self._openCzi().asarray(max_workers=self._maxWorkers).squeeze()
+        assert len(image.shape) == 4
+        self._channelData[self.CHANNEL_647] = image[self.CHANNEL_647, :, :, :]
+        self._channelData[self.CHANNEL_555] = image[self.CHANNEL_555, :, :, :]
+        self._channelData[self.CHANNEL_488] = image[self.CHANNEL_488, :, :, :]
+        self._channelData[self.CHANNEL_NUCLEUS] = image[self.CHANNEL_NUCLEUS, :, :, :]
+        if self._convert8bit:
+            for channel, data in self._channelData.items():
+                self._channelData[channel] = to8bit(data)
+
+    def _openCzi(self) -> CziFile:
+        if self._czi is None:
+            self._czi = CziFile(self._path)
+        return self._czi
+
+    def _readMetadata(self) -> Dict:
+        """
+        Read and check the image metadata we need from the CZI file header.
+        """
+        meta = self._openCzi().metadata(raw=False)
         imageInfo = meta['ImageDocument']['Metadata']['Information']['Image']
         distances = meta['ImageDocument']['Metadata']['Scaling']['Items']['Distance']
         assert len(distances) == 3
-        self._scale = {}
+        scale = {}
         for dist in distances:
-            self._scale[dist['Id']] = dist['Value'] * 1.0e06    # convert from meters to uM
+            scale[dist['Id']] = dist['Value'] * 1.0e06    # convert from meters to uM
         assert imageInfo['PixelType'] == 'Gray8' or imageInfo['PixelType'] == 'Gray16'
         assert imageInfo['ComponentBitCount'] == 8 or imageInfo['ComponentBitCount'] == 16
         assert imageInfo['SizeH'] == 1
-        self._sizeX = imageInfo['SizeX']
-        self._sizeY = imageInfo['SizeY']
-        self._sizeZ = imageInfo['SizeZ']
-        self._channels = imageInfo['SizeC']
-        image = czi.asarray().squeeze()
-        assert len(image.shape) == 4
-        self._647 = image[self.CHANNEL_647, :, :, :]
-        self._555 = image[self.CHANNEL_555, :, :, :]
-        self._488 = image[self.CHANNEL_488, :, :, :]
-        self._nucleus = image[self.CHANNEL_NUCLEUS, :, :, :]
-        if imageInfo['ComponentBitCount'] == 16:
-            self._647 = to8bit(self._647)
-            self._555 = to8bit(self._555)
-            self._488 = to8bit(self._488)
-            self._nucleus = to8bit(self._nucleus)
+        return {
+            'scale': scale,
+            'sizeX': imageInfo['SizeX'],
+            'sizeY': imageInfo['SizeY'],
+            'sizeZ': imageInfo['SizeZ'],
+            'channels': imageInfo['SizeC'],
+            'convert8bit': imageInfo['ComponentBitCount'] == 16
+        }
+
+    def _decodeRegion(self, out: np.ndarray, channel: int,
+                      z0: int, z1: int, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        """
+        Decode the region [z0:z1, y0:y1, x0:x1] of one channel into out, reading only
+        the subblocks in the CZI subblock directory that overlap it.
+        """
+        czi = self._openCzi()
+        axes = czi.axes
+        cAxis, zAxis, yAxis, xAxis = (axes.index(a) for a in 'CZYX')
+        origin = (z0, y0, x0)
+
+        def copyTile(entry, start, lo, hi):
+            tile = entry.data_segment().data()
+            # drop all singleton axes except Z, Y and X, which are always in that order
+            tile = tile[tuple(slice(None) if a in 'ZYX' else 0 for a in axes)]
+            tileStart = (start[zAxis], start[yAxis], start[xAxis])
+            out[tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, origin))] = \
+                tile[tuple(slice(l - t, h - t) for l, h, t in zip(lo, hi, tileStart))]
+
+        work = []
+        for entry in czi.filtered_subblock_directory:
+            start = [s - o for s, o in zip(entry.start, czi.start)]
+            shape = entry.shape
+            if start[cAxis] != channel:
+                continue
+            lo = (max(z0, start[zAxis]), max(y0, start[yAxis]), max(x0, start[xAxis]))
+            hi = (min(z1, start[zAxis] + shape[zAxis]),
+                  min(y1, start[yAxis] + shape[yAxis]),
+                  min(x1, start[xAxis] + shape[xAxis]))
+            if any(l >= h for l, h in zip(lo, hi)):
+                continue
+            work.append((entry, start, lo, hi))
+
+        maxWorkers = min(self._maxWorkers, len(work))
+        if maxWorkers > 1:
+            # Reads from the file are serialized by czifile's file handle lock, while
+            # decompression, which releases the GIL, runs in parallel.  Every tile lands
+            # in its own part of out, so the threads can write to it directly.
+            czi._fh.lock = True
+            try:
+                with ThreadPoolExecutor(maxWorkers) as executor:
+                    # list() re-raises any exception from the workers
+                    list(executor.map(lambda args: copyTile(*args), work))
+            finally:
+                czi._fh.lock = None
+        else:
+            for args in work:
+                copyTile(*args)
+        return out
+
+    def _decodeChannel(self, channel: int) -> np.ndarray:
+        """
+        Decode the selected slices of one channel into a (Z, Y, X) array
+        in the file's native pixel type.
+        """
+        z0 = self._firstSlice
+        z1 = self._lastSlice + 1
+        out = np.empty((z1 - z0, self._sizeY, self._sizeX), dtype=self._openCzi().dtype)
+        return self._decodeRegion(out, channel, z0, z1, 0, self._sizeY, 0, self._sizeX)
+
+    def _channel(self, channel: int) -> np.ndarray:
+        if channel not in self._channelData:
+            data = self._cache.loadChannel(self._cacheKey, channel) if self._cache else None
+            if data is None:
+                data = self._decodeChannel(channel)
+                if self._convert8bit:
+                    data = to8bit(data)
+                if self._cache:
+                    self._cache.storeChannel(self._cacheKey, channel, data)
+            self._channelData[channel] = data
+        return self._channelData[channel]
 
     def channel_647(self):
-        return self._647
+        return self._channel(self.CHANNEL_647)
 
     def channel_555(self):
-        return self._555
+        return self._channel(self.CHANNEL_555)
 
     def channel_488(self):
-        return self._488
+        return self._channel(self.CHANNEL_488)
 
     def channel_nucleus(self):
-        return self._nucleus
+        return self._channel(self.CHANNEL_NUCLEUS)
 
     def get_scale(self):
-        return self._scale
\ No newline at end of file
+        return self._scale
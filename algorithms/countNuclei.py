@@ -36,11 +36,12 @@ class ProcessStepCountNuclei(ProcessStep):
     def run(self, progressCallback: Callable[[int, str], None] = None):
         """
         Count the number of nuclei in each nucleus plane.
+        The nucleus channel is the last input, which may be the only one.
         Return in endOutputs the coordinates of the nuclei and the masked image we counted
         them on for the one where the count is greatest.
         Pass the input images unchanged to stepOutputs.
         """
-        assert isinstance(self._inputs, list) and len(self._inputs) > 1
+        assert isinstance(self._inputs, list) and len(self._inputs) > 0
         assert 'nucleus_slice' in self._params
         assert 'nucleus_mask_threshold' in self._params
         self._status = ProcessStatus.RUNNING
@@ -9,11 +9,18 @@
 
 from qtpy.QtWidgets import QApplication
 import numpy as np
-from bm4d import BM4DProfile, BM4DProfileBM3D, bm4d, BM4DStages
+from bm4d import BM4DPlan, BM4DProfile, BM4DProfileBM3D, bm4d, bm4d_slices, bm4d_tiled, BM4DStages
+from bm4d import get_brick_overlap, get_brick_weights, get_bricks
 from processing import ProcessStatus, ProcessStep, ProcessStepConcurrent
-from typing import Callable, Dict
+from typing import Callable, Dict, List, Tuple
+from functools import partial
 from os import getpid
 
+# Rough peak bytes per voxel of one BM4D hard-thresholding call at float32:
+# the binary's float32 input, estimate and aggregation buffers, the python-side
+# float64 copy of the input, the float32 result and the block-matching tables
+bm4dBytesPerVoxel = 48
+
 class DenoiseBM4D():
     """
     Class to directly call native Python version of BM4D with the same
@@ -26,34 +33,56 @@ class DenoiseBM4D():
     def denoise(self, image: np.ndarray, stddev: float, alpha_sharp: float = 1.3, progressCallback: object = None):
         profile = BM4DProfileBM3D()
         profile.set_sharpen(alpha_sharp)
-        denoised_image = np.zeros(image.shape)
-        slices = image.shape[0]
-        for z in range(slices):
-            if callable(progressCallback):
-                progressCallback(z, slices)
-            denoised_image[z, :, :] = bm4d(
-                image[z, :, :],
-                stddev,
-                profile,
-                stage_arg=BM4DStages.HARD_THRESHOLDING)[:, :, 0]
-        if callable(progressCallback):
-            progressCallback(slices, slices)
+        # every slice has the same size, profile and noise, so BM4D is set up once for all of them
+        denoised_image = bm4d_slices(
+            image,
+            stddev,
+            profile,
+            stage_arg=BM4DStages.HARD_THRESHOLDING,
+            progress_callback=progressCallback if callable(progressCallback) else None,
+            dtype=np.float32)
         return denoised_image
 
-    def denoise3d(self, volume: np.ndarray, stddev: float = 0., alpha_sharp: float = 1.3):
+    def denoise3d(self, volume: np.ndarray, stddev: float = 0., alpha_sharp: float = 1.3,
+                  brickSize: int = None, maxWorkers: int = 1):
+        """
+        Denoise the whole volume at once, or, if brickSize is given, in overlapping
+        bricks of about brickSize on a side, maxWorkers at a time, so that memory use
+        is bounded by the brick size rather than the volume size.
+        """
         profile = BM4DProfile()
         profile.set_sharpen(alpha_sharp)
-        denoised_volume = bm4d(volume, stddev, profile, stage_arg=BM4DStages.HARD_THRESHOLDING)
+        if brickSize:
+            return bm4d_tiled(volume, stddev, profile, stage_arg=BM4DStages.HARD_THRESHOLDING,
+                              brick_shape=(brickSize, brickSize, brickSize), max_workers=maxWorkers,
+                              dtype=np.float32)
+        denoised_volume = bm4d(volume, stddev, profile, stage_arg=BM4DStages.HARD_THRESHOLDING,
+                               dtype=np.float32)
         return denoised_volume
 
 class ProcessStepDenoiseImage(ProcessStep):
     """
     Processing step to denoise one image, or slice of a volume.
+    The input may also be a stack of slices (Z, Y, X), which are denoised
+    independently with one shared BM4D set-up.
     """
 
     def __init__(self, params: Dict = {}):
         super().__init__(params)
         self._stepName = "Denoise"
+        # ProcessStepConcurrent runs many slices through one instance, so keep
+        # the BM4D set-up for as long as the slice size and parameters don't change
+        self._plan: BM4DPlan = None
+        self._planKey = None
+
+    @classmethod
+    def outputLike(cls, input: np.ndarray, params: Dict):
+        # a single image comes back from bm4d() with a trailing axis of length 1
+        return (input.shape if input.ndim == 3 else input.shape + (1,)), np.float32
+
+    @classmethod
+    def taskMemory(cls, input: np.ndarray, params: Dict) -> int:
+        return input.size * bm4dBytesPerVoxel
 
     def run(self, progressCallback: Callable[[int, str], None] = None):
         assert len(self._inputs) > 0 and isinstance(self._inputs[0], np.ndarray)
@@ -61,14 +90,29 @@ class ProcessStepDenoiseImage(ProcessStep):
         assert 'sigma' in self._params.keys()
         self._stepOutputs = []
         self._endOutputs = []
-        profile = BM4DProfileBM3D()
-        profile.set_sharpen(self._params['sharpen'])
-        self._stepOutputs.append(bm4d(
-            self._inputs[0],
-            self._params['sigma'],
-            profile,
-            stage_arg=BM4DStages.HARD_THRESHOLDING
-            ))
+        image = self._inputs[0]
+        planKey = (image.shape[-2:], self._params['sigma'], self._params['sharpen'])
+        if planKey != self._planKey:
+            profile = BM4DProfileBM3D()
+            profile.set_sharpen(self._params['sharpen'])
+            self._plan = BM4DPlan(image.shape[-2:], self._params['sigma'], profile)
+            self._planKey = planKey
+        if image.ndim == 3:
+            self._stepOutputs.append(bm4d_slices(
+                image,
+                self._params['sigma'],
+                stage_arg=BM4DStages.HARD_THRESHOLDING,
+                plan=self._plan,
+                dtype=np.float32
+                ))
+        else:
+            self._stepOutputs.append(bm4d(
+                image,
+                self._params['sigma'],
+                stage_arg=BM4DStages.HARD_THRESHOLDING,
+                plan=self._plan,
+                dtype=np.float32
+                ))
         self._endOutputs.append(None)
         if progressCallback:
             progressCallback(100, self._stepName)
@@ -79,33 +123,238 @@ class ProcessStepDenoiseConcurrent(ProcessStep):
     Create a ProcessStepConcurrent composed of ProcessStepDenoiseImage steps
     to denoise all the slices of a volume as concurrently as possible.
     """
+    taskStep = ProcessStepDenoiseImage
+
     def __init__(self, params: Dict = {}):
         super().__init__(params)
         self._stepName = "DenoiseConcurrent"
 
+    @staticmethod
+    def splitTasks(inputVolume: np.ndarray, params: Dict) -> Tuple[List[np.ndarray], object]:
+        """
+        Return the inputs of the taskStep steps that denoise inputVolume, one per slice,
+        and the layout that assemble() needs to put their outputs back together.
+        """
+        assert len(inputVolume.shape) == 3
+        firstSlice = params['firstSlice'] if 'firstSlice' in params else 0
+        lastSlice = params['lastSlice'] if 'lastSlice' in params else -1
+        totalSlices = inputVolume.shape[0]
+        firstSlice = max(0, min(totalSlices, firstSlice))
+        lastSlice = min(totalSlices, totalSlices + lastSlice + 1 if lastSlice < 0 else lastSlice)-1
+        return [inputVolume[i] for i in range(firstSlice, lastSlice+1)], None
+
+    @staticmethod
+    def assemble(outputs: List[np.ndarray], layout: object) -> np.ndarray:
+        return np.array(outputs).squeeze()
+
     def run(self, progressCallback: Callable[[int, str], None] = None):
         # create a ProcessStepConcurrent of ProcessStepDenoiseImage steps, one per slice
         assert isinstance(self._inputs, list) and len(self._inputs) == 1
-        inputVolume = self._inputs[0]
+        slices, layout = self.splitTasks(self._inputs[0], self._params)
+        self._status = ProcessStatus.RUNNING
+        # assemble the slices straight from shared memory
+        concurrent = ProcessStepConcurrent(self.taskStep, self._params,
+                                           assemble=partial(self.assemble, layout=layout))
+        concurrent.setApp(self._app)
+        concurrent.setLogger(self._logger)
+        concurrent.setWorkerPool(self._workerPool)
+        concurrent.setInputs(slices)
+        concurrent.run(progressCallback)
+        status = concurrent.status()
+        if status == ProcessStatus.COMPLETED:
+            self._stepOutputs = [concurrent.stepOutputs()[0]]
+            self._endOutputs = concurrent.endOutputs()
+        else:
+            self._stepOutputs = []
+            self._endOutputs = []
+        self._status = status
+
+class ProcessStepDenoiseBrick(ProcessStep):
+    """
+    Processing step to denoise one brick of a volume with 3D BM4D.
+    """
+
+    def __init__(self, params: Dict = {}):
+        super().__init__(params)
+        self._stepName = "DenoiseBrick"
+        # most bricks of a volume are the same size, so keep the BM4D set-up between them
+        self._plan: BM4DPlan = None
+        self._planKey = None
+
+    @classmethod
+    def outputLike(cls, input: np.ndarray, params: Dict):
+        return input.shape, np.float32
+
+    @classmethod
+    def taskMemory(cls, input: np.ndarray, params: Dict) -> int:
+        return input.size * bm4dBytesPerVoxel
+
+    def run(self, progressCallback: Callable[[int, str], None] = None):
+        assert len(self._inputs) > 0 and isinstance(self._inputs[0], np.ndarray)
+        assert 'sharpen' in self._params.keys()
+        assert 'sigma' in self._params.keys()
+        self._stepOutputs = []
+        self._endOutputs = []
+        brick = self._inputs[0]
+        planKey = (brick.shape, self._params['sigma'], self._params['sharpen'])
+        if planKey != self._planKey:
+            profile = BM4DProfile()
+            profile.set_sharpen(self._params['sharpen'])
+            self._plan = BM4DPlan(brick.shape, self._params['sigma'], profile)
+            self._planKey = planKey
+        self._stepOutputs.append(bm4d(
+            brick,
+            self._params['sigma'],
+            stage_arg=BM4DStages.HARD_THRESHOLDING,
+            plan=self._plan,
+            dtype=np.float32
+            ))
+        self._endOutputs.append(None)
+        if progressCallback:
+            progressCallback(100, self._stepName)
+        self._status = ProcessStatus.COMPLETED
+
+class ProcessStepDenoise3DConcurrent(ProcessStep):
+    """
+    Create a ProcessStepConcurrent composed of ProcessStepDenoiseBrick steps
+    to denoise overlapping bricks of a volume with 3D BM4D as concurrently as
+    possible, then blend the bricks back into one volume.
+
+    params, besides sigma and sharpen, may include:
+        firstSlice, lastSlice   the range of slices to denoise, as for ProcessStepDenoiseConcurrent
+        brickSize               the size of the bricks before overlap is added, default 64
+    """
+    taskStep = ProcessStepDenoiseBrick
+
+    def __init__(self, params: Dict = {}):
+        super().__init__(params)
+        self._stepName = "Denoise3DConcurrent"
+
+    @staticmethod
+    def splitTasks(inputVolume: np.ndarray, params: Dict) -> Tuple[List[np.ndarray], object]:
+        """
+        Return the inputs of the taskStep steps that denoise inputVolume, one per brick,
+        and the layout that assemble() needs to blend their outputs back together.
+        """
         assert len(inputVolume.shape) == 3
-        firstSlice = self._params['firstSlice'] if 'firstSlice' in self._params else 0
-        lastSlice = self._params['lastSlice'] if 'lastSlice' in self._params else -1
+        firstSlice = params['firstSlice'] if 'firstSlice' in params else 0
+        lastSlice = params['lastSlice'] if 'lastSlice' in params else -1
+        brickSize = params['brickSize'] if 'brickSize' in params else 64
         totalSlices = inputVolume.shape[0]
         firstSlice = max(0, min(totalSlices, firstSlice))
         lastSlice = min(totalSlices, totalSlices + lastSlice + 1 if lastSlice < 0 else lastSlice)-1
-        slices = [inputVolume[i] for i in range(firstSlice, lastSlice+1)]
+        volume = inputVolume[firstSlice:lastSlice+1]
+        brickShape = tuple(min(brickSize, size) for size in volume.shape)
+        overlap = get_brick_overlap(BM4DProfile(), brickShape)
+        bricks = get_bricks(volume.shape, brickShape, overlap)
+        return [np.ascontiguousarray(volume[extent]) for extent in bricks], (volume.shape, bricks, overlap)
+
+    @staticmethod
+    def assemble(outputs: List[np.ndarray], layout: object) -> np.ndarray:
+        # blend the overlapping bricks across their seams
+        shape, bricks, overlap = layout
+        denoisedVolume = np.zeros(shape, dtype=np.float32)
+        for extent, denoisedBrick in zip(bricks, outputs):
+            denoisedVolume[extent] += denoisedBrick * get_brick_weights(shape, extent, overlap)
+        return denoisedVolume
+
+    def run(self, progressCallback: Callable[[int, str], None] = None):
+        assert isinstance(self._inputs, list) and len(self._inputs) == 1
+        bricks, layout = self.splitTasks(self._inputs[0], self._params)
         self._status = ProcessStatus.RUNNING
-        concurrent = ProcessStepConcurrent(ProcessStepDenoiseImage, self._params)
+        # blend the bricks straight from shared memory
+        concurrent = ProcessStepConcurrent(self.taskStep, self._params,
+                                           assemble=partial(self.assemble, layout=layout))
         concurrent.setApp(self._app)
         concurrent.setLogger(self._logger)
-        concurrent.setInputs(slices)
+        concurrent.setWorkerPool(self._workerPool)
+        concurrent.setInputs(bricks)
         concurrent.run(progressCallback)
         status = concurrent.status()
         if status == ProcessStatus.COMPLETED:
-            denoisedVolume = np.array(concurrent.stepOutputs()).squeeze()
-            self._stepOutputs = [denoisedVolume]
+            self._stepOutputs = [concurrent.stepOutputs()[0]]
             self._endOutputs = concurrent.endOutputs()
         else:
             self._stepOutputs = []
             self._endOutputs = []
         self._status = status
+
+class ProcessStepDenoiseChannelsConcurrent(ProcessStep):
+    """
+    Denoise several channels at once, with a params dict for each channel, by
+    submitting the slices (or, with use_denoise3d, the bricks) of every channel to
+    one ProcessStepConcurrent, each with its own channel's params.
+
+    This replaces a ProcessStepIterate of ProcessStepDenoiseConcurrent, where each
+    channel has to wait for the slowest slice of the one before it, leaving cores
+    idle; here the workers stay busy until the last channel is done.  The inputs and
+    outputs are the same: a list with one volume per channel.  All the channels are
+    denoised the same way, in 2D or 3D, as the first channel's params select.
+
+    The channels' tasks are queued in channel order, and each channel is assembled
+    as soon as its last task completes and passed to the partial output callback,
+    so the steps that need only the first channels can start on them early.
+    """
+    def __init__(self, paramsList: List[Dict] = []):
+        super().__init__(paramsList)
+        self._stepName = "DenoiseChannelsConcurrent"
+
+    def run(self, progressCallback: Callable[[int, str], None] = None):
+        assert isinstance(self._inputs, list) and len(self._inputs) == len(self._params)
+        denoiseStep = ProcessStepDenoise3DConcurrent if self._params[0].get('use_denoise3d', False) \
+            else ProcessStepDenoiseConcurrent
+        # gather every channel's tasks into one list, in channel order
+        tasks = []
+        taskParams = []
+        layouts = []
+        taskChannels = []
+        for channel, (volume, params) in enumerate(zip(self._inputs, self._params)):
+            channelTasks, layout = denoiseStep.splitTasks(volume, params)
+            tasks.extend(channelTasks)
+            taskParams.extend([params] * len(channelTasks))
+            layouts.append((len(channelTasks), layout))
+            taskChannels.extend([channel] * len(channelTasks))
+        starts = np.cumsum([0] + [nTasks for nTasks, _ in layouts])
+        remaining = [nTasks for nTasks, _ in layouts]
+        taskOutputs = [None] * len(tasks)
+        volumes = [None] * len(layouts)
+
+        def taskDone(idx: int, output: np.ndarray) -> None:
+            # once a channel's last task is done, assemble it from shared memory and pass it on
+            channel = taskChannels[idx]
+            taskOutputs[idx] = output
+            remaining[channel] -= 1
+            channelOutputs = taskOutputs[starts[channel]:starts[channel + 1]]
+            if remaining[channel] > 0 or any(output is None for output in channelOutputs):
+                return
+            volumes[channel] = denoiseStep.assemble(channelOutputs, layouts[channel][1])
+            self._partialOutputCallback(channel, volumes[channel])
+
+        def assembleChannels(outputs: List[np.ndarray]) -> List[np.ndarray]:
+            # split the outputs back up by channel, assembling them straight from shared memory,
+            # except for those already assembled
+            for channel, (nTasks, layout) in enumerate(layouts):
+                if volumes[channel] is None:
+                    volumes[channel] = denoiseStep.assemble(outputs[starts[channel]:starts[channel + 1]], layout)
+            return volumes
+
+        self._status = ProcessStatus.RUNNING
+        concurrent = ProcessStepConcurrent(denoiseStep.taskStep, self._params[0], taskParams,
+                                           assemble=assembleChannels,
+                                           taskDone=taskDone if self._partialOutputCallback else None)
+        concurrent.setApp(self._app)
+        concurrent.setLogger(self._logger)
+        concurrent.setWorkerPool(self._workerPool)
+        concurrent.setInputs(tasks)
+        concurrent.run(progressCallback)
+        status = concurrent.status()
+        self._stepOutputs = []
+        self._endOutputs = []
+        if status == ProcessStatus.COMPLETED:
+            self._stepOutputs = concurrent.stepOutputs()[0]
+            endOutputs = concurrent.endOutputs()[0]
+            start = 0
+            for nTasks, layout in layouts:
+                self._endOutputs.append(endOutputs[start:start + nTasks])
+                start += nTasks
+        self._status = status
@@ -10,6 +10,9 @@ from os import getpid
 from logging import Logger
 from skimage.feature import blob_log
 
+# blob_log's default number of scales; it builds a float64 cube with one image per scale
+blobLogScales = 10
+
 def detect_spots(image: np.ndarray, thresh: float, logger: Logger = None):
     logger.info(f"Worker {getpid()}: Detecting spots")
     coords = blob_log(image, threshold=thresh)
@@ -24,6 +27,17 @@ class ProcessStepDetectSpots(ProcessStep):
         super().__init__(params)
         self._stepName = "DetectSpots"
 
+    @classmethod
+    def taskMemory(cls, input, params: Dict) -> int:
+        # the inputs arrive wrapped in lists
+        while isinstance(input, list):
+            input = input[0]
+        if not isinstance(input, np.ndarray):
+            return 0
+        # two normalized float32 copies, then blob_log's scale-space cube and
+        # the maximum filter of it
+        return input.size * (2 * 4 + 2 * blobLogScales * 8)
+
     def run(self, progressCallback: Callable[..., Tuple[int, str]] = None) -> None:
         assert isinstance(self._inputs, list) and len(self._inputs) == 1
         assert 'spot_detect_threshold' in self._params
@@ -72,6 +86,7 @@ class ProcessStepDetectSpotsConcurrent(ProcessStep):
         concurrent = ProcessStepConcurrent(ProcessStepDetectSpots, self._params)
         concurrent.setApp(self._app)
         concurrent.setLogger(self._logger)
+        concurrent.setWorkerPool(self._workerPool)
         concurrent.setInputs(self._inputs)
         concurrent.run(progressCallback)
         status = concurrent.status()
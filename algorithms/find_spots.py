@@ -7,9 +7,13 @@ This code can take processing parameters in the form of a YAML file specified on
 command line, but also has reasonable default parameters if none are specified.
 
 command line:  python find_spots.py input_image_file output_image_file
+
+To process a batch of files with the same process steps as FindSpotsTool, without
+a display, use findSpotsBatch.py instead.
 """
 
 from matplotlib.pyplot import xscale
+from algorithms.channel_cache import ChannelCache
 from algorithms.confocal_file import ConfocalFile
 # from algorithms.denoise import Denoise, DenoiseBM4D
 from algorithms.denoise import DenoiseBM4D
@@ -43,11 +47,16 @@ default_params = {
     'touching_threshold_y': 0.14,
     'touching_threshold_z': 0.53,
     'use_denoise3d': False,
+    'denoise3d_brick_size': None,   # denoise3d in overlapping bricks of this size to bound memory; None uses the whole volume
+    'denoise3d_workers': 1,         # bricks denoised at the same time
     'nucleus_slice': 10,
     'count_nuclei': False,
     'save_after_denoise': False,
     'save_spots': True,
-    'save_spot_image': False
+    'save_spot_image': False,
+    'cache_dir': None,      # directory for caching decoded channels between runs; None disables
+    'cache_max_gb': 20,
+    'pipeline_batch': True  # in batch runs, decode the next file and write the last file's outputs in the background
 }
 
 def get_param(key, params):
@@ -75,14 +84,17 @@ def find_spots(image_file: str, out_name: str, params_yaml_file: str = None):
             print(f"Couldn't open params file {params_yaml_file} because of {e}")
             print("Using default params")
 
+    first_slice = get_param('first_slice', params)
+    last_slice = get_param('last_slice', params)
     try:
-        cf = ConfocalFile(image_file)
+        # only decode the slices we're going to process
+        cache_dir = get_param('cache_dir', params)
+        cache = ChannelCache(cache_dir, int(get_param('cache_max_gb', params) * 1024**3)) if cache_dir else None
+        cf = ConfocalFile(image_file, firstSlice=first_slice, lastSlice=last_slice, cache=cache)
     except Exception as e:
         print(f"Image file {image_file} could not be opened.  Error was: {e}")
         exit(-1)
 
-    first_slice = get_param('first_slice', params)
-    last_slice = get_param('last_slice', params)
     sigma = get_param('sigma', params)
     alpha_sharp = get_param('alpha_sharp', params)
     spot_detect_thresh = get_param('spot_detect_threshold', params)
@@ -91,6 +103,8 @@ def find_spots(image_file: str, out_name: str, params_yaml_file: str = None):
     max_triplet_LR_size = get_param('max_triplet_LR_size', params)
     touching_threshold = get_param('touching_threshold', params)
     use_denoise3d = get_param('use_denoise3d', params)
+    denoise3d_brick_size = get_param('denoise3d_brick_size', params)
+    denoise3d_workers = get_param('denoise3d_workers', params)
     # use_bm4d = get_param('use_bm4d', params)
     save_after_denoise = get_param('save_after_denoise', params)
     save_spots = get_param('save_spots', params)
@@ -99,7 +113,7 @@ def find_spots(image_file: str, out_name: str, params_yaml_file: str = None):
     if save_after_denoise:
         stem, _ = splitext(inputFile)
         save_name = stem + "_antibody"
-        save_components(cf.channel_nucleus()[first_slice:last_slice], save_name)
+        save_components(cf.channel_nucleus(), save_name)
 
     denoiser = DenoiseBM4D()
     # if use_bm4d:
@@ -112,9 +126,10 @@ def find_spots(image_file: str, out_name: str, params_yaml_file: str = None):
     #TODO: make these steps concurrent
     print("Denoising 3'CRM")
     if use_denoise3d:
-        denoised_3CRM = denoiser.denoise3d(cf.channel_647()[first_slice:last_slice], sigma, alpha_sharp)
+        denoised_3CRM = denoiser.denoise3d(cf.channel_647(), sigma, alpha_sharp,
+                                           denoise3d_brick_size, denoise3d_workers)
     else:
-        denoised_3CRM = denoiser.denoise(cf.channel_647()[first_slice:last_slice], sigma, alpha_sharp)
+        denoised_3CRM = denoiser.denoise(cf.channel_647(), sigma, alpha_sharp)
     if save_after_denoise:
         stem, _ = splitext(inputFile)
         save_name = stem + "_3CRM_denoised"
@@ -127,9 +142,10 @@ def find_spots(image_file: str, out_name: str, params_yaml_file: str = None):
 
     print("Denoising 5'CRM")
     if use_denoise3d:
-        denoised_5CRM = denoiser.denoise3d(cf.channel_555()[first_slice:last_slice], sigma, alpha_sharp)
+        denoised_5CRM = denoiser.denoise3d(cf.channel_555(), sigma, alpha_sharp,
+                                           denoise3d_brick_size, denoise3d_workers)
     else:
-        denoised_5CRM = denoiser.denoise(cf.channel_555()[first_slice:last_slice], sigma, alpha_sharp)
+        denoised_5CRM = denoiser.denoise(cf.channel_555(), sigma, alpha_sharp)
     if save_after_denoise:
         stem, _ = splitext(inputFile)
         save_name = stem + "_5CRM_denoised"
@@ -142,9 +158,10 @@ def find_spots(image_file: str, out_name: str, params_yaml_file: str = None):
 
     print("Denoising PPE")
     if use_denoise3d:
-        denoised_PPE = denoiser.denoise3d(cf.channel_488()[first_slice:last_slice], sigma)
+        denoised_PPE = denoiser.denoise3d(cf.channel_488(), sigma,
+                                          brickSize=denoise3d_brick_size, maxWorkers=denoise3d_workers)
     else:
-        denoised_PPE = denoiser.denoise(cf.channel_488()[first_slice:last_slice], sigma, alpha_sharp)
+        denoised_PPE = denoiser.denoise(cf.channel_488(), sigma, alpha_sharp)
     if save_after_denoise:
         stem, _ = splitext(inputFile)
         save_name = stem + "_PPE_denoised"
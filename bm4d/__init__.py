@@ -12,9 +12,12 @@ Y. Mäkinen, S. Marchesini, A. Foi, 2021,
 
 """
 
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import functools
 import os
-from typing import List, Union, Tuple
+import threading
+from typing import Callable, List, Union, Tuple
 
 from scipy.fftpack import *
 from scipy.linalg import *
@@ -36,6 +39,7 @@ from .bm4d_ctypes import bm4d_wie as _bm4d_wie
 from .bm4d_ctypes import bm4d_ht as _bm4d_ht
 from .bm4d_ctypes import bm4d_ht_complex as _bm4d_ht_complex
 from .bm4d_ctypes import BlockMatchStorage
+from .bm4d_ctypes import get_transforms as _get_c_transforms
 
 from .profiles import BM4DProfile, BM4DProfileRefilter, BM4DProfile2D, BM4DProfile2DRefilter
 from .profiles import BM4DProfileBM3D, BM4DProfileBM3DComplex, BM4DProfileComplex, BM4DStages
@@ -89,10 +93,96 @@ def bm4d_multichannel(z: Union[List[np.ndarray], np.ndarray], sigma_psd: Union[n
     return np.array(full_denoi)
 
 
+class BM4DPlan:
+    """
+    Precomputed state for repeated BM4D runs on images of the same size with the same
+    profile and noise: the processed profile and PSD, and for each stage the block shifts,
+    transform matrices and the flattened transform tables passed to the binary.
+    Create one per (profile, shape, sigma_psd) and pass it to bm4d() as plan, so that
+    each call only runs the filtering itself.
+    """
+
+    def __init__(self, shape: tuple, sigma_psd: Union[np.ndarray, float],
+                 profile: Union[BM4DProfile, str] = 'np'):
+        """
+        :param shape: shape of the images to be denoised. 2-D shapes will cast to 3-D
+        :param sigma_psd: Noise PSD of that shape, or
+               sigma_psd: Noise standard deviation (float)
+        :param profile: Settings for BM4D: BM4DProfile object or a string, as for bm4d()
+        """
+        if len(shape) == 1:
+            raise ValueError("z must be either a 2D or a 3D image!")
+        if len(shape) == 2:
+            shape = (shape[0], shape[1], 1)
+        self.shape = tuple(shape)
+
+        # Profile selection, if profile is a string, otherwise BM4DProfile.
+        pro = _select_profile(profile, self.shape)
+
+        # If profile defines maximum required pad, use that, otherwise use image size
+        self.pad_size = (int(np.ceil(shape[0] / 2)), int(np.ceil(shape[1] / 2)), int(np.ceil(shape[2] / 2))) \
+            if pro.max_pad_size is None else pro.max_pad_size
+
+        # Conventional mode
+        if np.sum(pro.nf) == 0:
+            pro.nf = (np.minimum(shape[0], 16), np.minimum(shape[1], 16), np.minimum(shape[2], 16))
+            pro.k = 0
+            pro.gamma = 0
+
+        if shape[0] < pro.bs_ht[0] or shape[1] < pro.bs_ht[1] or shape[2] < pro.bs_ht[2] or \
+                shape[0] < pro.bs_wiener[0] or shape[1] < pro.bs_wiener[1] or shape[2] < pro.bs_wiener[2]:
+            raise ValueError("Image cannot be smaller than block size!")
+
+        sigma_psd = np.array(sigma_psd)
+        sigma = sigma_psd if sigma_psd.size == 1 else None
+        single_d = False
+
+        if sigma is not None:
+            # White noise: a flat PSD only carries its level, so instead of a full-size PSD
+            # the binary gets one no bigger than N_f, scaled by its own size as it expects.
+            psd_shape = tuple(int(max(1, min(s, n))) for s, n in zip(self.shape, pro.nf))
+            sigma_psd = np.ones(psd_shape) * np.prod(psd_shape) * sigma ** 2
+            single_d = True
+        # Format single dimension (std) sigma_psds
+        elif np.squeeze(sigma_psd).ndim <= 1:
+            sigma_psd = np.ones(self.shape) * np.prod(self.shape) * sigma_psd ** 2
+            single_d = True
+
+        sigma_psd = np.atleast_3d(sigma_psd)
+
+        # Process PSD to be resizable to N_f (this also fills in the profile's shrinkage parameters)
+        self.sigma_psd2, self.psd_blur, self.psd_k = _process_psd(sigma_psd, self.shape, single_d,
+                                                                  self.pad_size, pro)
+        if sigma is not None:
+            # Residual refiltering thresholds the residual's spectrum against the PSD level of
+            # the whole image, which broadcasts over any padded size
+            self.sigma_psd2 = np.ones((1, 1, 1)) * np.prod(self.shape) * sigma ** 2
+        self.profile = pro
+        self._stages = {}
+
+    def stage(self, stage_ht: bool) -> tuple:
+        """
+        Get the precomputed inputs of one filtering stage, computing them on first use.
+        :param stage_ht: True for hard-thresholding, False for Wiener filtering
+        :return: qshifts, t_forward, t_inverse, hadper_trans_single_den, inverse_hadper_trans_single_den,
+                wwin3d, transforms (the transforms C struct for the binary)
+        """
+        if stage_ht not in self._stages:
+            pro = self.profile
+            if stage_ht:
+                qshifts = get_shift_params(pro.bs_ht, pro.step_ht)
+            else:
+                qshifts = get_shift_params(pro.bs_wiener, pro.step_wiener)
+            transf = _get_transforms(pro, stage_ht)
+            self._stages[stage_ht] = (qshifts,) + tuple(transf) + (_get_c_transforms(*transf),)
+        return self._stages[stage_ht]
+
+
 def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
          profile: Union[BM4DProfile, str] = 'np',
          stage_arg: Union[BM4DStages, np.ndarray] = BM4DStages.ALL_STAGES,
-         blockmatches: Tuple[Union[BlockMatchStorage, bool], Union[BlockMatchStorage, bool]] = (False, False)) \
+         blockmatches: Tuple[Union[BlockMatchStorage, bool], Union[BlockMatchStorage, bool]] = (False, False),
+         plan: 'BM4DPlan' = None, dtype: np.dtype = np.float64) \
         -> Union[np.ndarray, Tuple[np.ndarray, Tuple[Union[BlockMatchStorage, bool], Union[BlockMatchStorage, bool]]]]:
     """
     Perform BM4D denoising on z: either hard-thresholding, Wiener filtering or both.
@@ -115,28 +205,30 @@ def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
                         False -> Do not use or collect repeat blockmatches (default)
                         True -> Save blockmatches, return (y_hat, (blockmatches_ht, blockmatches_wie))
                     or BlockMatchStorage object (profiles.py) that was returned by a previous application of BM4D.
+    :param plan: BM4DPlan created for the size of z, to reuse its precomputed profile, PSD and transforms.
+                    sigma_psd and profile are ignored when a plan is given.
+    :param dtype: type of the denoised image. The binary works in float32, so np.float32
+                    returns its output without widening it.
     :return:
         - denoised image, same size as z
     """
     # Ensure z is 3-D a numpy array
-    z = np.array(z)
+    z = np.asarray(z)
     if z.ndim == 1:
         raise ValueError("z must be either a 2D or a 3D image!")
     if z.ndim == 2:
         z = np.atleast_3d(z)
 
-    # Profile selection, if profile is a string, otherwise BM4DProfile.
-    pro = _select_profile(profile, z)
-
-    # If profile defines maximum required pad, use that, otherwise use image size
-    pad_size = (int(np.ceil(z.shape[0] / 2)), int(np.ceil(z.shape[1] / 2)), int(np.ceil(z.shape[2] / 2))) \
-        if pro.max_pad_size is None else pro.max_pad_size
+    if plan is None:
+        plan = BM4DPlan(z.shape, sigma_psd, profile)
+    elif plan.shape != z.shape:
+        raise ValueError("plan was created for a different image size than z!")
 
-    # Conventional mode
-    if np.sum(pro.nf) == 0:
-        pro.nf = (np.minimum(z.shape[0], 16), np.minimum(z.shape[1], 16), np.minimum(z.shape[2], 16))
-        pro.k = 0
-        pro.gamma = 0
+    pro = plan.profile
+    pad_size = plan.pad_size
+    sigma_psd2 = plan.sigma_psd2
+    psd_blur = plan.psd_blur
+    psd_k = plan.psd_k
 
     y_hat = None
 
@@ -150,28 +242,11 @@ def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
     elif stage_arg == BM4DStages.WIENER_FILTERING:
         raise ValueError("If you wish to only perform Wiener filtering, you need to pass an estimate as stage_arg!")
 
-    if z.shape[0] < pro.bs_ht[0] or z.shape[1] < pro.bs_ht[1] or z.shape[2] < pro.bs_ht[2] or \
-            z.shape[0] < pro.bs_wiener[0] or z.shape[1] < pro.bs_wiener[1] or z.shape[2] < pro.bs_wiener[2]:
-        raise ValueError("Image cannot be smaller than block size!")
-
     # If this is true, we are doing hard thresholding (whether we do Wiener later or not)
     stage_ht = (stage_arg.value & BM4DStages.HARD_THRESHOLDING.value) != 0
     # If this is true, we are doing Wiener filtering
     stage_wie = (stage_arg.value & BM4DStages.WIENER_FILTERING.value) != 0
 
-    sigma_psd = np.array(sigma_psd)
-    single_d = False
-
-    # Format single dimension (std) sigma_psds
-    if np.squeeze(sigma_psd).ndim <= 1:
-        sigma_psd = np.ones(z.shape) * z.size * sigma_psd ** 2
-        single_d = True
-
-    sigma_psd = np.atleast_3d(sigma_psd)
-
-    # Process PSD to be resizable to N_f
-    sigma_psd2, psd_blur, psd_k = _process_psd(sigma_psd, z, single_d, pad_size, pro)
-
     bm_out_ht = None
     bm_out_wie = None
 
@@ -186,6 +261,7 @@ def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
 
     ht_fn = _bm4d_ht_complex if inp_complex else _bm4d_ht
     wie_fn = _bm4d_wie_complex if inp_complex else _bm4d_wie
+    est_dtype = np.complex64 if inp_complex else dtype
 
     try:
         bm_in_ht = blockmatches[0]
@@ -196,14 +272,14 @@ def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
     # Step 1. Produce the basic estimate by HT filtering
     if stage_ht:
 
-        qshifts = get_shift_params(pro.bs_ht, pro.step_ht)
-        # Get used transforms and aggregation windows.
-        t_forward, t_inverse, hadper_trans_single_den, \
-            inverse_hadper_trans_single_den, wwin3d = _get_transforms(pro, True)
+        # Get block shifts, used transforms and aggregation windows.
+        qshifts, t_forward, t_inverse, hadper_trans_single_den, \
+            inverse_hadper_trans_single_den, wwin3d, transforms = plan.stage(True)
 
         # Call the actual hard-thresholding step with the acquired parameters
         y_hat, bm_out_ht = ht_fn(z, psd_blur, pro, t_forward, t_inverse, qshifts, hadper_trans_single_den,
-                                inverse_hadper_trans_single_den, wwin3d, blockmatches=bm_in_ht)
+                                inverse_hadper_trans_single_den, wwin3d, blockmatches=bm_in_ht,
+                                transforms=transforms, dtype=est_dtype)
 
         if pro.print_info:
             print('Hard-thresholding stage completed')
@@ -217,7 +293,8 @@ def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
             if np.min(np.max(np.max(remains_psd, axis=0), axis=0)) > 1e-5:
                 # Re-filter
                 y_hat, bm_out_ht = ht_fn(y_hat + remains, remains_psd, pro, t_forward, t_inverse, qshifts, hadper_trans_single_den,
-                                        inverse_hadper_trans_single_den, wwin3d, True, blockmatches=bm_in_ht)
+                                        inverse_hadper_trans_single_den, wwin3d, True, blockmatches=bm_in_ht,
+                                        transforms=transforms, dtype=est_dtype)
 
     # Error (probably OOM) occured, do not process further
     if np.mean(y_hat) == np.min(y_hat):
@@ -228,14 +305,14 @@ def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
 
     if stage_wie:
 
-        qshifts = get_shift_params(pro.bs_wiener, pro.step_wiener)
-        # Get used transforms and aggregation windows.
-        t_forward, t_inverse, hadper_trans_single_den, \
-            inverse_hadper_trans_single_den, wwin3d = _get_transforms(pro, False)
+        # Get block shifts, used transforms and aggregation windows.
+        qshifts, t_forward, t_inverse, hadper_trans_single_den, \
+            inverse_hadper_trans_single_den, wwin3d, transforms = plan.stage(False)
 
         # Wiener filtering
         y_hat, bm_out_wie = wie_fn(z, psd_blur, pro, t_forward, t_inverse, qshifts, hadper_trans_single_den,
-                                    inverse_hadper_trans_single_den, wwin3d, y_hat, blockmatches=bm_in_wie)
+                                    inverse_hadper_trans_single_den, wwin3d, y_hat, blockmatches=bm_in_wie,
+                                    transforms=transforms, dtype=est_dtype)
 
         # Residual denoising, Wiener
         if pro.denoise_residual:
@@ -244,7 +321,8 @@ def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
 
             if np.min(np.max(np.max(remains_psd, axis=0), axis=0)) > 1e-5:
                 y_hat, bm_out_wie = wie_fn(y_hat + remains, remains_psd, pro, t_forward, t_inverse, qshifts, hadper_trans_single_den,
-                                        inverse_hadper_trans_single_den, wwin3d, y_hat, True, blockmatches=bm_in_wie)
+                                        inverse_hadper_trans_single_den, wwin3d, y_hat, True, blockmatches=bm_in_wie,
+                                        transforms=transforms, dtype=est_dtype)
 
         if pro.print_info:
             print('Wiener-filtering stage completed')
@@ -260,6 +338,175 @@ def bm4d(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
 
     return y_hat
 
+def bm4d_slices(z: np.ndarray, sigma_psd: Union[np.ndarray, float],
+                profile: Union[BM4DProfile, str] = 'np',
+                stage_arg: Union[BM4DStages, np.ndarray] = BM4DStages.ALL_STAGES,
+                out: np.ndarray = None, plan: 'BM4DPlan' = None,
+                progress_callback: Callable[[int, int], None] = None,
+                dtype: np.dtype = np.float64) -> np.ndarray:
+    """
+    Perform BM4D denoising independently on every 2-D slice of a stack, as bm4d() would
+    on each slice, but with the profile, PSD and transforms set up only once for all of them.
+
+    :param z: stack of noisy 2-D images (Z x Y x X)
+    :param sigma_psd: Noise PSD the size of one slice, or
+           sigma_psd: Noise standard deviation (float)
+    :param profile: Settings for BM4D: BM4DProfile object or a string, as for bm4d().
+                    String profiles select 2-D blocks for slices.
+    :param stage_arg: Determines whether to perform hard-thresholding or wiener filtering, as for bm4d().
+                    An estimate must be a stack the same size as z.
+    :param out: array the same size as z to write the denoised slices into, or None to allocate one
+    :param plan: BM4DPlan created for the size of one slice, or None to create one here.
+                    sigma_psd and profile are ignored when a plan is given.
+    :param progress_callback: called with (slices done, total slices) before each slice and at the end
+    :param dtype: type of the denoised stack, if out is not given
+    :return:
+        - denoised stack, same size as z
+    """
+    if z.ndim != 3:
+        raise ValueError("z must be a stack of 2D images!")
+    if isinstance(stage_arg, np.ndarray) and stage_arg.shape != z.shape:
+        raise ValueError("Estimate passed in stage_arg must be equal size to z!")
+    if out is None:
+        out = np.zeros(z.shape, dtype=dtype)
+
+    if plan is None:
+        plan = BM4DPlan(z.shape[1:], sigma_psd, profile)
+    slices = z.shape[0]
+    for i in range(slices):
+        if progress_callback is not None:
+            progress_callback(i, slices)
+        slice_stage_arg = stage_arg[i] if isinstance(stage_arg, np.ndarray) else stage_arg
+        out[i] = bm4d(z[i], sigma_psd, stage_arg=slice_stage_arg, plan=plan, dtype=out.dtype)[:, :, 0]
+    if progress_callback is not None:
+        progress_callback(slices, slices)
+    return out
+
+
+def get_brick_overlap(profile: Union[BM4DProfile, str] = 'np', brick_shape: tuple = (64, 64, 64)) -> tuple:
+    """
+    Get the overlap each brick of a tiled run needs on every side, per axis, so that block matching
+    near a seam sees the same neighbourhood as it would in the whole volume:
+    the search window plus the block size of whichever stage reaches further.
+    :param profile: BM4DProfile object or a string, as for bm4d()
+    :param brick_shape: shape of the bricks, used to select a string profile
+    :return: overlap per axis
+    """
+    pro = _select_profile(profile, brick_shape)
+    return tuple(int(max(pro.search_window_ht[i], pro.search_window_wiener[i]) +
+                     max(pro.bs_ht[i], pro.bs_wiener[i])) for i in range(3))
+
+
+def get_bricks(shape: tuple, brick_shape: tuple, overlap: tuple) -> List[Tuple[slice, slice, slice]]:
+    """
+    Split a volume into a grid of bricks of about brick_shape, each extended by overlap on
+    every side that is not at the edge of the volume.
+    Along each axis, bricks are at least 2 * overlap before extension, so that seams don't meet.
+    :param shape: shape of the volume
+    :param brick_shape: shape of the bricks before extension by overlap
+    :param overlap: overlap per axis
+    :return: list of the bricks' extents as tuples of slices into the volume
+    """
+    axis_extents = []
+    for size, brick, margin in zip(shape, brick_shape, overlap):
+        count = max(1, int(np.ceil(size / brick)))
+        while count > 1 and size // count < 2 * margin:
+            count -= 1
+        bounds = [i * size // count for i in range(count + 1)]
+        axis_extents.append([slice(max(0, bounds[i] - margin), min(size, bounds[i + 1] + margin))
+                             for i in range(count)])
+    return [(ex, ey, ez) for ex in axis_extents[0] for ey in axis_extents[1] for ez in axis_extents[2]]
+
+
+def get_brick_weights(shape: tuple, extent: Tuple[slice, slice, slice], overlap: tuple) -> np.ndarray:
+    """
+    Get the blending weights of a brick from get_bricks(). Weights ramp linearly across the
+    2 * overlap wide seams between bricks, so that the weights of all bricks sum to 1 everywhere.
+    :param shape: shape of the volume
+    :param extent: the brick's extent, as returned by get_bricks()
+    :param overlap: overlap per axis
+    :return: weights, broadcastable to the size of the brick
+    """
+    weights = np.ones((1, 1, 1))
+    for axis, (size, ext, margin) in enumerate(zip(shape, extent, overlap)):
+        w = np.ones(ext.stop - ext.start)
+        if margin > 0:
+            x = np.arange(ext.start, ext.stop) + 0.5
+            if ext.start > 0:
+                w *= np.clip((x - ext.start) / (2 * margin), 0, 1)
+            if ext.stop < size:
+                w *= np.clip((ext.stop - x) / (2 * margin), 0, 1)
+        weights = weights * w.reshape([-1 if i == axis else 1 for i in range(3)])
+    return weights
+
+
+def bm4d_tiled(z: np.ndarray, sigma_psd: float,
+               profile: Union[BM4DProfile, str] = 'np',
+               stage_arg: Union[BM4DStages, np.ndarray] = BM4DStages.ALL_STAGES,
+               brick_shape: tuple = (64, 64, 64), overlap: tuple = None,
+               out: np.ndarray = None, max_workers: int = 1, dtype: np.dtype = np.float64) -> np.ndarray:
+    """
+    Perform BM4D denoising on z one overlapping brick at a time, and blend the bricks
+    across the seams, so that peak memory depends on the brick size rather than the volume size.
+    z and out may be memory-mapped arrays; only one brick of each is read into memory at a time
+    (per worker).
+
+    :param z: 3-D Noisy image
+    :param sigma_psd: Noise standard deviation (float). A PSD can't be split into bricks.
+    :param profile: Settings for BM4D: BM4DProfile object or a string, as for bm4d()
+    :param stage_arg: Determines whether to perform hard-thresholding or wiener filtering, as for bm4d().
+                    An estimate must be the same size as z.
+    :param brick_shape: shape of the bricks, before they are extended by overlap
+    :param overlap: overlap on each side of a brick, per axis, or None to use get_brick_overlap()
+    :param out: array the same size as z to write the denoised volume into, or None to allocate one.
+                    It is overwritten with zeros before the bricks are accumulated in it.
+    :param max_workers: number of bricks to denoise at the same time, in threads
+    :param dtype: type of the denoised volume, if out is not given
+    :return:
+        - denoised volume, same size as z
+    """
+    if z.ndim != 3:
+        raise ValueError("z must be a 3D image!")
+    if np.array(sigma_psd).size != 1:
+        raise ValueError("Tiled BM4D needs sigma_psd to be a noise standard deviation!")
+    if isinstance(stage_arg, np.ndarray) and stage_arg.shape != z.shape:
+        raise ValueError("Estimate passed in stage_arg must be equal size to z!")
+    brick_shape = tuple(min(b, s) for b, s in zip(brick_shape, z.shape))
+    if overlap is None:
+        overlap = get_brick_overlap(profile, brick_shape)
+    if out is None:
+        out = np.zeros(z.shape, dtype=dtype)
+    else:
+        out[...] = 0
+
+    plans = {}
+    lock = threading.Lock()
+
+    def denoise_brick(extent):
+        brick = np.asarray(z[extent])
+        with lock:
+            if brick.shape not in plans:
+                plans[brick.shape] = BM4DPlan(brick.shape, sigma_psd, profile)
+            plan = plans[brick.shape]
+        brick_stage_arg = stage_arg[extent] if isinstance(stage_arg, np.ndarray) else stage_arg
+        estimate = bm4d(brick, sigma_psd, stage_arg=brick_stage_arg, plan=plan, dtype=out.dtype)
+        estimate *= get_brick_weights(z.shape, extent, overlap)
+        with lock:
+            out[extent] += estimate
+
+    bricks = get_bricks(z.shape, brick_shape, overlap)
+    if max_workers > 1:
+        # The binary releases the GIL, so bricks run in parallel in threads and
+        # there is no need to copy them to other processes
+        with ThreadPoolExecutor(max_workers) as executor:
+            # list() re-raises any exception from the workers
+            list(executor.map(denoise_brick, bricks))
+    else:
+        for extent in bricks:
+            denoise_brick(extent)
+    return out
+
+
 def get_filtered_residual(z: np.ndarray, y_hat: np.ndarray, sigma_psd: Union[np.ndarray, float],
                           pad_size: Union[list, tuple], residual_thr: float) -> (np.ndarray, np.ndarray):
     """
@@ -395,17 +642,18 @@ def _process_psd_for_nf(sigma_psd: np.ndarray, psd_k: Union[np.ndarray, None], p
     return sigma_psd_copy
 
 
-def _select_profile(profile: Union[str, BM4DProfile], z: np.ndarray) -> BM4DProfile:
+def _select_profile(profile: Union[str, BM4DProfile], z_shape: tuple) -> BM4DProfile:
     """
     Select profile for BM4D
     :param profile: BM4DProfile or a string
+    :param z_shape: shape of the noisy image (3-D)
     :return: BM4DProfile object
     """
     if isinstance(profile, BM4DProfile):
         return copy.copy(profile)
 
     # The default profile for shapes which can contain a 5-pixel wide block
-    elif z.shape[2] >= 5:
+    elif z_shape[2] >= 5:
         if profile == 'np':
             return BM4DProfile()
         elif profile == '8x8':
@@ -614,13 +862,13 @@ def _get_kernel_from_psd(sigma_psd: Union[np.ndarray, float], single_dim_psd: bo
     return fftshift(np.real(ifftn(sig, axes=(0, 1, 2))), axes=(0, 1, 2))
 
 
-def _process_psd(sigma_psd: Union[np.ndarray, float], z: np.ndarray,
+def _process_psd(sigma_psd: Union[np.ndarray, float], z_shape: tuple,
                  single_dim_psd: bool, pad_size: tuple, profile: BM4DProfile) \
         -> (np.ndarray, np.ndarray, np.ndarray):
     """
     Process input PSD for BM4D to acquire relevant inputs.
     :param sigma_psd: PSD (MxNxC) or a list of stds
-    :param z: noisy image
+    :param z_shape: shape of the noisy image
     :param single_dim_psd: True if original input was sigma, not PSD
     :param pad_size: size to pad for refiltering
     :param profile: BM4DProfile used for this run
@@ -653,7 +901,7 @@ def _process_psd(sigma_psd: Union[np.ndarray, float], z: np.ndarray,
 
         pads_width = ((pad_size[0], pad_size[0]), (pad_size[1], pad_size[1]), (pad_size[2], pad_size[2]))
         temp_kernel = np.pad(temp_kernel, pads_width, 'constant')
-        sigma_psd2 = abs(fftn(temp_kernel, axes=(0, 1, 2))) ** 2 * z.shape[0] * z.shape[1] * z.shape[2]
+        sigma_psd2 = abs(fftn(temp_kernel, axes=(0, 1, 2))) ** 2 * z_shape[0] * z_shape[1] * z_shape[2]
     else:
         sigma_psd2 = sigma_psd
 
@@ -771,6 +1019,31 @@ def _get_transforms(profile_obj: BM4DProfile, stage_ht: bool) -> tuple:
     return t_forward, t_inverse, hadper_trans_single_den, inverse_hadper_trans_single_den, wwin3d
 
 
+@functools.lru_cache(maxsize=None)
+def _get_param_matching_table() -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+    """
+    Load the optimal parameters and matching features for a bunch of PSDs from
+    param_matching_data.mat, and whiten the features for nearest-neighbour queries.
+    The table is loaded once per process, on first use.
+    :return: (whitened features (20 x 500), feature means, PCA basis, sqrt of PCA variances,
+            optimal parameter indices (500 x 4))
+    """
+    path = os.path.dirname(__file__)
+    data = loadmat(os.path.join(path, 'param_matching_data.mat'))
+    features = data['features']
+    maxes = data['maxes']
+    data_sz = features.shape[1]
+
+    mm = np.mean(features, 1)
+    f2 = features - np.repeat(np.atleast_2d(mm).T, data_sz, axis=1)
+    c = f2 @ f2.T
+    c /= data_sz
+    u, s, v = svd(c)
+    f2 = u @ f2
+    f2 = f2 * np.repeat(np.atleast_2d(np.sqrt(s)).T, data_sz, axis=1)
+    return f2, mm, u, np.sqrt(s), maxes
+
+
 def _estimate_parameters_for_psd(psd65_full: np.ndarray) -> (list, list, list, list):
     """
     Estimate BM3D parameters based on the PSD.
@@ -778,14 +1051,9 @@ def _estimate_parameters_for_psd(psd65_full: np.ndarray) -> (list, list, list, l
     :return: (lambda, mu, refiltering lambda, refiltering mu)
     """
 
-    # Get the optimal parameters and matching features for a bunch of PSDs
-    path = os.path.dirname(__file__)
-    data = loadmat(os.path.join(path, 'param_matching_data.mat'))
-    features = data['features']
-    maxes = data['maxes']
+    f2, mm, u, sqrt_s, maxes = _get_param_matching_table()
 
     sz = 65
-    data_sz = 500
     indices_to_take = [1, 3, 5, 7, 9, 12, 17, 22, 27, 32]
 
     llambda = []
@@ -793,42 +1061,31 @@ def _estimate_parameters_for_psd(psd65_full: np.ndarray) -> (list, list, list, l
     llambda2 = []
     wielambda2 = []
 
-    # Get separate parameters for each PSD provided
-    for psd_num in range(psd65_full.shape[2] if len(psd65_full.shape) > 2 else 1):
+    psd65_full = np.atleast_3d(psd65_full)
 
-        if len(psd65_full.shape) > 2:
-            psd65 = fftshift(psd65_full[:, :, psd_num], axes=(0, 1))
-        else:
-            psd65 = fftshift(psd65_full[:, :], axes=(0, 1))
-
-        # Get features for this PSD
-        pcaxa = _get_features(psd65, sz, indices_to_take)
-
-        # Calculate distances to other PSDs
-        mm = np.mean(features, 1)
-        f2 = features - np.repeat(np.atleast_2d(mm).T, data_sz, axis=1)
-        c = f2 @ f2.T
-        c /= data_sz
-        pcax2 = pcaxa.T - mm
-        u, s, v = svd(c)
-        f2 = u @ f2
-        pcax2 = u @ pcax2
-        f2 = f2 * np.repeat(np.atleast_2d(np.sqrt(s)).T, 500, axis=1)
-        pcax2 = pcax2 * np.sqrt(s)
-
-        diff_pcax = np.sqrt(np.sum(abs(f2 - np.repeat(np.atleast_2d(pcax2).T, data_sz, axis=1)) ** 2, 0))
-        dff_i = np.argsort(diff_pcax)
-
-        # Take 20 most similar PSDs into consideration
-        count = 20
-        diff_indices = dff_i[0:count]
-
-        # Invert, smaller -> bigger weight
-        diff_inv = 1. / (diff_pcax + EPS)
-        diff_inv = diff_inv[diff_indices] / np.sum(diff_inv[diff_indices])
-
-        # Weight
-        param_idxs = np.sum(diff_inv * maxes[diff_indices, :].T, 1)
+    # Get features for each PSD provided, one row per PSD
+    pcaxa = np.array([_get_features(fftshift(psd65_full[:, :, psd_num], axes=(0, 1)), sz, indices_to_take)
+                      for psd_num in range(psd65_full.shape[2])])
+
+    # Project the features onto the whitened PCA basis of the table
+    pcax2 = ((pcaxa - mm) @ u.T) * sqrt_s
+
+    # Calculate distances from every PSD to the PSDs in the table
+    diff_pcax = np.sqrt(np.sum(abs(f2[np.newaxis, :, :] - pcax2[:, :, np.newaxis]) ** 2, 1))
+
+    # Take 20 most similar PSDs into consideration
+    count = 20
+    diff_indices = np.argsort(diff_pcax, axis=1)[:, 0:count]
+
+    # Invert, smaller -> bigger weight
+    diff_inv = np.take_along_axis(1. / (diff_pcax + EPS), diff_indices, axis=1)
+    diff_inv = diff_inv / np.sum(diff_inv, axis=1, keepdims=True)
+
+    # Weight
+    all_param_idxs = np.sum(diff_inv[:, :, np.newaxis] * maxes[diff_indices, :], 1)
+
+    # Get separate parameters for each PSD provided
+    for param_idxs in all_param_idxs:
 
         lambdas = np.linspace(2.5, 4.5, 21)
         wielambdas = np.linspace(0.2, 4.2, 21)
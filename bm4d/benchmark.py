@@ -0,0 +1,51 @@
+# benchmark.py
+
+"""
+Benchmark the unpacking of the BM4D binary's output buffer, and check that the
+vectorized unpack_estimate() is bit-identical to the per-voxel loop it replaced.
+
+command line:  python -m bm4d.benchmark [sizeY sizeX sizeZ]
+"""
+
+import numpy as np
+import sys
+from time import perf_counter
+
+from .bm4d_ctypes import unpack_estimate
+
+def unpack_estimate_loop(c_est: np.ndarray, z_shape: tuple) -> np.ndarray:
+    """
+    The original per-voxel unpacking loop, kept as the reference implementation.
+    """
+    res = np.zeros(z_shape)
+    for i in range(z_shape[0]):
+        for j in range(z_shape[1]):
+            for k in range(z_shape[2]):
+                res[i, j, k] = c_est[k * z_shape[0] * z_shape[1] +
+                                     i * z_shape[1] + j]
+    return res
+
+def benchmark_unpack(z_shape: tuple) -> None:
+    rng = np.random.default_rng(0)
+    c_est = rng.random(z_shape[0] * z_shape[1] * z_shape[2], dtype=np.float32)
+
+    start = perf_counter()
+    expected = unpack_estimate_loop(c_est, z_shape)
+    loopTime = perf_counter() - start
+
+    start = perf_counter()
+    result = unpack_estimate(c_est, z_shape)
+    vectorTime = perf_counter() - start
+
+    assert result.dtype == expected.dtype and result.shape == expected.shape
+    assert np.array_equal(result, expected), "vectorized unpacking differs from the reference loop"
+    print(f"shape {z_shape}: loop {loopTime:.3f}s, vectorized {vectorTime:.4f}s, "
+          f"{loopTime / max(vectorTime, 1e-9):.0f}x faster, bit-identical")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 3:
+        shape = (int(sys.argv[1]), int(sys.argv[2]), int(sys.argv[3]))
+        benchmark_unpack(shape)
+    else:
+        for shape in [(256, 256, 1), (64, 48, 16), (2048, 2048, 1)]:
+            benchmark_unpack(shape)
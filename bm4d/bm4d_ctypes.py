@@ -202,21 +202,22 @@ class BlockMatchStorageCtype(ctypes.Structure):
 
 
 # Argument types for HT function call
-ARGTYPES_THR = [ctypes.POINTER(ctypes.c_float),  # sourceImage
-                ctypes.POINTER(ctypes.c_float),  # PSD
+# Image-sized buffers are passed straight from contiguous float32 numpy arrays
+ARGTYPES_THR = [np.ctypeslib.ndpointer(np.float32, ndim=1, flags='C'),  # sourceImage
+                np.ctypeslib.ndpointer(np.float32, ndim=1, flags='C'),  # PSD
                 Parameters,
                 Transforms,
-                ctypes.POINTER(ctypes.c_float),  # estimate
+                np.ctypeslib.ndpointer(np.float32, ndim=1, flags='C,W'),  # estimate
                 ctypes.POINTER(BlockMatchStorageCtype)
                 ]
 
 # Argument types for Wiener function call
-ARGTYPES_WIE = [ctypes.POINTER(ctypes.c_float),  # sourceImage
-                ctypes.POINTER(ctypes.c_float),  # PSD
+ARGTYPES_WIE = [np.ctypeslib.ndpointer(np.float32, ndim=1, flags='C'),  # sourceImage
+                np.ctypeslib.ndpointer(np.float32, ndim=1, flags='C'),  # PSD
                 Parameters,
                 Transforms,
-                ctypes.POINTER(ctypes.c_float),  # reference
-                ctypes.POINTER(ctypes.c_float),  # estimate
+                np.ctypeslib.ndpointer(np.float32, ndim=1, flags='C'),  # reference
+                np.ctypeslib.ndpointer(np.float32, ndim=1, flags='C,W'),  # estimate
                 ctypes.POINTER(BlockMatchStorageCtype)
                 ]
 
@@ -251,6 +252,28 @@ def conv_to_array(pyarr, ctype=ctypes.c_float):
     return (ctype * len(pyarr))(*pyarr)
 
 
+def flat_float32(arr: np.ndarray) -> np.ndarray:
+    """
+    Get a 1-d, C-contiguous float32 view of arr to pass to the binary, copying only
+    if arr is not already in that layout.
+    :param arr: numpy array
+    :return: flattened float32 array
+    """
+    return np.ascontiguousarray(arr, dtype=np.float32).ravel()
+
+
+def unpack_estimate(c_est: np.ndarray, z_shape: tuple, dtype=np.float64) -> np.ndarray:
+    """
+    Convert the estimate written by the binary, which is stored with the 3rd dimension
+    outermost, back to an array of z_shape.
+    :param c_est: flat estimate buffer
+    :param z_shape: shape of z
+    :param dtype: type of the result. If it is the type of c_est, the result is a view of c_est.
+    :return: estimate, same size as z
+    """
+    return c_est.reshape(z_shape[2], z_shape[0], z_shape[1]).transpose(1, 2, 0).astype(dtype, copy=False)
+
+
 def flatten_transf(transf_dict: dict, dtype=np.float32, cdtype=ctypes.c_float): # -> ctypes.POINTER(ctypes.POINTER()):
     """
     Flatten the stack transforms computed by __get_transforms to format used by the binary.
@@ -557,7 +580,7 @@ def bm4d_ht(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
             hadper_trans_single_den: Union[list, None],
             inverse_hadper_trans_single_den: Union[list, None],
             wwin3d: np.ndarray, refilter:bool=False,
-            blockmatches=False)\
+            blockmatches=False, transforms=None, dtype=np.float64)\
         -> Tuple[np.ndarray, Optional[BlockMatchStorage]]:
     """
     Perform hard-thresholding through the BM4D binary.
@@ -572,14 +595,17 @@ def bm4d_ht(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
     :param wwin3d: windowing function for aggregation
     :param refilter: use refiltering parameters
     :param blockmatches: block-matching data, or True to collect, False to ignore
+    :param transforms: transforms C struct built from the transforms above, or None to build it here
+    :param dtype: type of the returned estimate; np.float32 returns the binary's output without conversion
     :return: hard-thresholded estimate
     """
     z_shape = z.shape
     psd_shape = psd.shape
 
     params = get_params_ht(pro, z_shape, psd_shape, np.max(z) - np.min(z), refilter, qshifts)
-    transforms = get_transforms(t_forward, t_inverse, hadper_trans_single_den,
-                                inverse_hadper_trans_single_den, wwin3d)
+    if transforms is None:
+        transforms = get_transforms(t_forward, t_inverse, hadper_trans_single_den,
+                                    inverse_hadper_trans_single_den, wwin3d)
 
     stack_storage_size = (z.shape[0] + 1) * (z.shape[1] + 1) * (z.shape[2] + 1) // \
                          (pro.step_ht[0] * pro.step_ht[1] * pro.step_ht[2])
@@ -587,20 +613,13 @@ def bm4d_ht(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
 
     z = np.transpose(z, [2, 0, 1])
     psd = np.transpose(psd, [2, 0, 1])
-    res = np.zeros(z_shape)
-
-    c_z = conv_to_array(np.ascontiguousarray(z.flatten(), dtype=np.float32), ctype=ctypes.c_float)
-    c_psd = conv_to_array(np.ascontiguousarray(psd.flatten(), dtype=np.float32), ctype=ctypes.c_float)
-    c_est = conv_to_array(np.ascontiguousarray(res.flatten(), dtype=np.float32), ctype=ctypes.c_float)
-
+    c_z = flat_float32(z)
+    c_psd = flat_float32(psd)
+    c_est = np.zeros(c_z.size, dtype=np.float32)
 
     func_ht(c_z, c_psd, params, transforms, c_est, ctypes.byref(matchtables) if matchtables is not None else matchtables)
 
-    for i in range(z_shape[0]):
-        for j in range(z_shape[1]):
-            for k in range(z_shape[2]):
-                res[i, j, k] = c_est[k * z_shape[0] * z_shape[1] +
-                                     i * z_shape[1] + j]
+    res = unpack_estimate(c_est, z_shape, dtype)
 
     bm_out = None
     if isinstance(blockmatches, bool) and blockmatches:
@@ -615,7 +634,7 @@ def bm4d_ht_complex(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
             hadper_trans_single_den: Union[list, None],
             inverse_hadper_trans_single_den: Union[list, None],
             wwin3d: np.ndarray, refilter:bool=False,
-            blockmatches=False)\
+            blockmatches=False, transforms=None, dtype=np.complex64)\
         -> Tuple[np.ndarray, Optional[BlockMatchStorage]]:
     """
     Perform hard-thresholding through the BM4D binary.
@@ -630,14 +649,17 @@ def bm4d_ht_complex(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
     :param wwin3d: windowing function for aggregation
     :param refilter: use refiltering parameters
     :param blockmatches: block-matching data, or True to collect, False to ignore
+    :param transforms: transforms C struct built from the transforms above, or None to build it here
+    :param dtype: type of the returned estimate
     :return: hard-thresholded estimate
     """
     z_shape = z.shape
     psd_shape = psd.shape
 
     params = get_params_ht(pro, z_shape, psd_shape, np.max(z) - np.min(z), refilter, qshifts)
-    transforms = get_transforms_complex(t_forward, t_inverse, hadper_trans_single_den,
-                                inverse_hadper_trans_single_den, wwin3d)
+    if transforms is None:
+        transforms = get_transforms_complex(t_forward, t_inverse, hadper_trans_single_den,
+                                            inverse_hadper_trans_single_den, wwin3d)
     params.cutPSD = ctypes.c_bool(False) # Only guaranteed symmetric with real transforms
 
     stack_storage_size = (z.shape[0] + 1) * (z.shape[1] + 1) * (z.shape[2] + 1) // \
@@ -646,21 +668,15 @@ def bm4d_ht_complex(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
 
     z = np.transpose(z, [2, 0, 1])
     psd = np.transpose(psd, [2, 0, 1])
-    res = np.zeros(z_shape, dtype=np.complex64)
-
     c_z = (np.ascontiguousarray(z.flatten(), dtype=np.complex64))
-    c_psd = conv_to_array(np.ascontiguousarray(psd.flatten(), dtype=np.float), ctype=ctypes.c_float)
-    c_est = np.ascontiguousarray(res.flatten(), dtype=np.complex64)
+    c_psd = flat_float32(psd).ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+    c_est = np.zeros(c_z.size, dtype=np.complex64)
     if pro.adjust_complex_params:
         params.lambdaSq = lambda_convert(np.sqrt(params.lambdaSq)) ** 2
 
     func_ht_complex(c_z, c_psd, params, transforms, c_est, ctypes.byref(matchtables) if matchtables is not None else matchtables)
 
-    for i in range(z_shape[0]):
-        for j in range(z_shape[1]):
-            for k in range(z_shape[2]):
-                res[i, j, k] = c_est[k * z_shape[0] * z_shape[1] +
-                                     i * z_shape[1] + j]
+    res = unpack_estimate(c_est, z_shape, dtype)
 
     bm_out = None
     if isinstance(blockmatches, bool) and blockmatches:
@@ -674,7 +690,7 @@ def bm4d_wie(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
              hadper_trans_single_den: Union[list, None],
              inverse_hadper_trans_single_den: Union[list, None], wwin3d: np.ndarray,
              ref: np.ndarray, refilter:bool=False,
-             blockmatches=False) \
+             blockmatches=False, transforms=None, dtype=np.float64) \
         -> Tuple[np.ndarray, Optional[BlockMatchStorage]]:
     """
     Perform Wiener filtering through the BM4D binary.
@@ -690,6 +706,8 @@ def bm4d_wie(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
     :param ref: reference signal same size as z (usually HT estimate)
     :param refilter: use refiltering parameters
     :param blockmatches: block-matching data, or True to collect, False to ignore
+    :param transforms: transforms C struct built from the transforms above, or None to build it here
+    :param dtype: type of the returned estimate; np.float32 returns the binary's output without conversion
 
     :return: Wiener estimate
     """
@@ -698,18 +716,17 @@ def bm4d_wie(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
     psd_shape = psd.shape
 
     params = get_params_wie(pro, z_shape, psd_shape, np.max(ref) - np.min(ref), refilter, qshifts)
-    transforms = get_transforms(t_forward, t_inverse, hadper_trans_single_den, inverse_hadper_trans_single_den, wwin3d)
+    if transforms is None:
+        transforms = get_transforms(t_forward, t_inverse, hadper_trans_single_den, inverse_hadper_trans_single_den, wwin3d)
 
     z = np.transpose(z, [2, 0, 1])
     psd = np.transpose(psd, [2, 0, 1])
     ref = np.transpose(ref, [2, 0, 1])
 
-    res = np.zeros(z_shape)
-
-    c_z = conv_to_array(np.ascontiguousarray(z.flatten(), dtype=np.float32), ctype=ctypes.c_float)
-    c_psd = conv_to_array(np.ascontiguousarray(psd.flatten(), dtype=np.float32), ctype=ctypes.c_float)
-    c_est = conv_to_array(np.ascontiguousarray(res.flatten(), dtype=np.float32), ctype=ctypes.c_float)
-    c_ref = conv_to_array(np.ascontiguousarray(ref.flatten(), dtype=np.float32), ctype=ctypes.c_float)
+    c_z = flat_float32(z)
+    c_psd = flat_float32(psd)
+    c_est = np.zeros(c_z.size, dtype=np.float32)
+    c_ref = flat_float32(ref)
 
     stack_storage_size = (z.shape[0] + 1) * (z.shape[1] + 1) * (z.shape[2] + 1) // \
                          (pro.step_wiener[0] * pro.step_wiener[1] * pro.step_wiener[2])
@@ -717,11 +734,7 @@ def bm4d_wie(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
 
     func_wie(c_z, c_psd, params, transforms, c_ref, c_est, ctypes.byref(matchtables) if matchtables is not None else matchtables)
 
-    for i in range(z_shape[0]):
-        for j in range(z_shape[1]):
-            for k in range(z_shape[2]):
-                res[i, j, k] = c_est[k * z_shape[0] * z_shape[1] +
-                                     i * z_shape[1] + j]
+    res = unpack_estimate(c_est, z_shape, dtype)
 
     bm_out = None
     if isinstance(blockmatches, bool) and blockmatches:
@@ -738,7 +751,7 @@ def bm4d_wie_complex(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
              hadper_trans_single_den: Union[list, None],
              inverse_hadper_trans_single_den: Union[list, None], wwin3d: np.ndarray,
              ref: np.ndarray, refilter:bool=False,
-             blockmatches=False) \
+             blockmatches=False, transforms=None, dtype=np.complex64) \
         -> Tuple[np.ndarray, Optional[BlockMatchStorage]]:
     """
     Perform Wiener filtering through the BM4D binary.
@@ -754,6 +767,8 @@ def bm4d_wie_complex(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
     :param ref: reference signal same size as z (usually HT estimate)
     :param refilter: use refiltering parameters
     :param blockmatches: block-matching data, or True to collect, False to ignore
+    :param transforms: transforms C struct built from the transforms above, or None to build it here
+    :param dtype: type of the returned estimate
 
     :return: Wiener estimate
     """
@@ -762,18 +777,17 @@ def bm4d_wie_complex(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
     psd_shape = psd.shape
 
     params = get_params_wie(pro, z_shape, psd_shape, np.max(ref) - np.min(ref), refilter, qshifts)
-    transforms = get_transforms_complex(t_forward, t_inverse, hadper_trans_single_den, inverse_hadper_trans_single_den, wwin3d)
+    if transforms is None:
+        transforms = get_transforms_complex(t_forward, t_inverse, hadper_trans_single_den, inverse_hadper_trans_single_den, wwin3d)
     params.cutPSD = ctypes.c_bool(False) # Only guaranteed symmetric with real transforms
 
     z = np.transpose(z, [2, 0, 1])
     psd = np.transpose(psd, [2, 0, 1])
     ref = np.transpose(ref, [2, 0, 1])
 
-    res = np.zeros(z_shape, dtype=np.complex64)
-
     c_z = (np.ascontiguousarray(z.flatten(), dtype=np.complex64))
-    c_psd = conv_to_array(np.ascontiguousarray(psd.flatten(), dtype=np.float), ctype=ctypes.c_float)
-    c_est = np.ascontiguousarray(res.flatten(), dtype=np.complex64)
+    c_psd = flat_float32(psd).ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+    c_est = np.zeros(c_z.size, dtype=np.complex64)
     c_ref = np.ascontiguousarray(ref.flatten(), dtype=np.complex64)
 
     stack_storage_size = (z.shape[0] + 1) * (z.shape[1] + 1) * (z.shape[2] + 1) // \
@@ -783,11 +797,7 @@ def bm4d_wie_complex(z: np.ndarray, psd: np.ndarray, pro: profiles.BM4DProfile,
 
     func_wie_complex(c_z, c_psd, params, transforms, c_ref, c_est, ctypes.byref(matchtables) if matchtables is not None else matchtables)
 
-    for i in range(z_shape[0]):
-        for j in range(z_shape[1]):
-            for k in range(z_shape[2]):
-                res[i, j, k] = c_est[k * z_shape[0] * z_shape[1] +
-                                     i * z_shape[1] + j]
+    res = unpack_estimate(c_est, z_shape, dtype)
 
     bm_out = None
     if isinstance(blockmatches, bool) and blockmatches:
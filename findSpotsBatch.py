@@ -0,0 +1,480 @@
+# findSpotsBatch.py
+
+"""
+Find spots in a batch of confocal files without a display, running the same
+sequence of process steps as FindSpotsTool.
+
+Params come from an optional YAML file with the keys of default_params in
+algorithms/find_spots.py.  sigma, alpha_sharp and spot_detect_threshold can also
+be set for a single channel by prefixing them with left_, middle_, right_ or
+nucleus_ (e.g. left_sigma: 20); otherwise every channel uses the unprefixed value.
+
+Each input is a .czi file, a directory of .czi files, or a glob pattern, and more
+can be listed one per line in a manifest file.  The outputs are written next to each
+input file, or in the output directory.  While one file is processed, the next one
+is decoded and the outputs of the previous one are written in the background.
+
+Once all of a file's outputs are written, a completion record, <stem>_completed.json,
+is written atomically beside them.  A file is skipped if its record shows it was
+completed with the same params and it hasn't changed since.
+
+For a cluster array job, --shard K/N processes only every Nth file of the sorted list,
+starting with file K (counting from 0).  In a SLURM array job the shard is taken from
+SLURM_ARRAY_TASK_ID and SLURM_ARRAY_TASK_COUNT if --shard isn't given; this needs the
+array to be a range, optionally with a step (e.g. --array=0-9 or 1-19:2), not a list
+of task ids, whose tasks can't be numbered without gaps.  Once all the
+shards are done, --merge STEM, given the same inputs and params, checks that every file
+has been completed with those params and hasn't changed since, and combines their outputs
+into STEM_distances.csv and STEM_results.csv, with the input file in the first column.
+Files that fail are reported, and the rest of the batch carries on.
+
+command line:  python findSpotsBatch.py [-p params.yaml] [-o output_dir] [-w workers] [-f] [-v]
+                   [-m manifest] [--shard K/N | --merge STEM] [input ...]
+"""
+
+from algorithms.find_spots import default_params, get_param
+from algorithms.channel_cache import ChannelCache
+from algorithms.confocal_file import ConfocalFile
+from findSpotsPipeline import buildProcessGraph, gatherOutputs, outputSuffixes, runProcessGraph, writeOutputs
+from processing import WorkerPool
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from glob import glob
+from hashlib import sha1
+import json
+from logging import INFO, WARNING, Logger
+import multiprocessing as mp
+import os
+import socket
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+import yaml
+
+channelNames = ['left', 'middle', 'right', 'nucleus']
+completionSuffix = "_completed.json"
+
+def readManifest(manifestFile: str) -> List[str]:
+    """
+    Read the inputs listed in a manifest file, one per line.  Blank lines and
+    lines starting with # are ignored.
+    """
+    with open(manifestFile, 'r') as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line and not line.startswith('#')]
+
+def findInputFiles(inputs: List[str]) -> List[str]:
+    """
+    Expand the inputs into a sorted list of .czi files, without duplicates
+    """
+    files = set()
+    for input in inputs:
+        if os.path.isdir(input):
+            files.update(glob(os.path.join(input, "*.czi")))
+        elif os.path.isfile(input):
+            files.add(input)
+        else:
+            files.update(path for path in glob(input) if os.path.isfile(path))
+    return sorted(os.path.abspath(path) for path in files)
+
+def parseShard(shard: str) -> Tuple[int, int]:
+    """
+    Parse a shard given as K/N, checking that 0 <= K < N
+    """
+    try:
+        shardIndex, shardCount = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard {shard} is not of the form K/N")
+    if shardCount < 1 or not 0 <= shardIndex < shardCount:
+        raise argparse.ArgumentTypeError(f"shard {shard} needs 0 <= K < N")
+    return shardIndex, shardCount
+
+def workerCount(workers: str) -> int:
+    """
+    Parse the number of worker processes, which must be at least 2, so that one
+    can collect the results while the others work
+    """
+    try:
+        count = int(workers)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"workers {workers} is not a number")
+    if count < 2:
+        raise argparse.ArgumentTypeError(f"at least 2 workers are needed, not {count}")
+    return count
+
+def threadCount(threads: str) -> int:
+    """
+    Parse the number of BLAS/OpenMP threads per worker, which must be at least 1
+    """
+    try:
+        count = int(threads)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"threads {threads} is not a number")
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"at least 1 thread is needed, not {count}")
+    return count
+
+def slurmShard() -> Optional[Tuple[int, int]]:
+    """
+    Return the (index, count) shard of a SLURM array job task, or None outside an array job.
+    Only an array that is a range, with an optional step, can be sharded, since
+    the tasks of a list of ids, like 1,5,9, can't be numbered 0 to N-1 without gaps.
+    Raises ValueError for other arrays.
+    """
+    if 'SLURM_ARRAY_TASK_ID' not in os.environ or 'SLURM_ARRAY_TASK_COUNT' not in os.environ:
+        return None
+    taskId = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    taskCount = int(os.environ['SLURM_ARRAY_TASK_COUNT'])
+    taskMin = int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    taskMax = int(os.environ.get('SLURM_ARRAY_TASK_MAX', taskMin + taskCount - 1))
+    taskStep = int(os.environ.get('SLURM_ARRAY_TASK_STEP', 1))
+    if taskMax - taskMin != taskStep * (taskCount - 1) or (taskId - taskMin) % taskStep != 0:
+        raise ValueError(f"the SLURM array of {taskCount} tasks from {taskMin} to {taskMax} isn't a range "
+                         "with a fixed step; use --shard K/N")
+    return parseShard(f"{(taskId - taskMin) // taskStep}/{taskCount}")
+
+def paramsDigest(params: Dict) -> str:
+    """
+    Digest the params with the defaults filled in, so that changing a default
+    also makes earlier outputs out of date
+    """
+    resolved = {key: get_param(key, params) for key in set(default_params) | set(params)}
+    return sha1(json.dumps(resolved, sort_keys=True, default=str).encode()).hexdigest()
+
+def outputStem(inputFile: str, outputDir: str = None) -> str:
+    stem, _ = os.path.splitext(inputFile)
+    if outputDir:
+        stem = os.path.join(outputDir, os.path.basename(stem))
+    return stem
+
+def readCompletion(outStem: str) -> Optional[Dict]:
+    """
+    Return the completion record written for a file's outputs, or None if it wasn't completed
+    """
+    try:
+        with open(outStem + completionSuffix, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def writeCompletion(inputFile: str, outStem: str, digest: str, shard: str) -> None:
+    """
+    Record that all of a file's outputs have been written.  The record is written under
+    a temporary name and renamed, so it is never seen partly written.
+    """
+    stat = os.stat(inputFile)
+    record = {
+        'input': inputFile,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'params': digest,
+        'outputs': [outStem + suffix for suffix in outputSuffixes],
+        'shard': shard,
+        'host': socket.gethostname(),
+        'completed': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+    tmpPath = f"{outStem}{completionSuffix}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmpPath, 'w') as f:
+        json.dump(record, f, indent=1)
+    os.replace(tmpPath, outStem + completionSuffix)
+
+def isUpToDate(inputFile: str, outStem: str, digest: str) -> bool:
+    """
+    Return True if the file was completed with the same params, and hasn't changed since
+    """
+    record = readCompletion(outStem)
+    if record is None:
+        return False
+    stat = os.stat(inputFile)
+    return record.get('size') == stat.st_size and record.get('mtime_ns') == stat.st_mtime_ns and \
+        record.get('params') == digest and all(os.path.exists(output) for output in record.get('outputs', []))
+
+def channelParam(params: Dict, channel: str, key: str):
+    return params[f"{channel}_{key}"] if f"{channel}_{key}" in params else get_param(key, params)
+
+def channelParamsList(params: Dict) -> List[Dict]:
+    """
+    Build the per-channel params for the left, middle, right and nucleus channels,
+    the same way FindSpotsTool builds them from its UI
+    """
+    perChannelParamsList = []
+    for channel in channelNames:
+        channelParams = {
+            'firstSlice': 0,    # the ConfocalFile holds only the selected slices
+            'lastSlice': -1,
+            'sigma': channelParam(params, channel, 'sigma'),
+            'sharpen': channelParam(params, channel, 'alpha_sharp'),
+            'use_denoise3d': bool(get_param('use_denoise3d', params)),
+            # find_spots.py denoises the whole volume when this is None; here the volume is
+            # always split into bricks to run on the workers, so use the usual size then
+            'brickSize': get_param('denoise3d_brick_size', params) or 64
+        }
+        if channel == 'nucleus':
+            channelParams.update({
+                'nucleus_mask_threshold': get_param('nucleus_mask_threshold', params),
+                'count_nuclei': bool(get_param('count_nuclei', params)),
+                'nucleus_slice': get_param('nucleus_slice', params) - max(0, get_param('first_slice', params))
+            })
+        else:
+            channelParams.update({
+                'spot_detect_threshold': channelParam(params, channel, 'spot_detect_threshold'),
+                'save_spot_image': bool(get_param('save_spot_image', params))
+            })
+        perChannelParamsList.append(channelParams)
+    return perChannelParamsList
+
+def openConfocalFile(inputFile: str, params: Dict, cache: ChannelCache) -> ConfocalFile:
+    return ConfocalFile(inputFile, firstSlice=get_param('first_slice', params),
+                        lastSlice=get_param('last_slice', params), cache=cache)
+
+def processFile(cf: ConfocalFile, outStem: str, params: Dict, workerPool: WorkerPool, logger: Logger) -> Dict:
+    """
+    Run the process steps on one opened file.  Returns the arguments of writeOutputs(),
+    or None if a step didn't complete.
+    """
+    scale = cf.get_scale()
+    perChannelParamsList = channelParamsList(params)
+    tripletsParams = {
+        'find_doublets': bool(get_param('find_doublets', params)),
+        'max_triplet_size': get_param('max_triplet_size', params),
+        'max_triplet_LR_size': get_param('max_triplet_LR_size', params)
+    }
+    touchingParams = {
+        'touching_threshold': [
+            get_param('touching_threshold_x', params),
+            get_param('touching_threshold_y', params),
+            get_param('touching_threshold_z', params)
+        ]
+    }
+    channelFromString = {
+        '647': cf.channel_647,
+        '555': cf.channel_555,
+        '488': cf.channel_488
+    }
+    spotChannels = [channelFromString[str(get_param(f"{channel}_channel", params))]()
+                    for channel in channelNames[:3]]
+    countNuclei = bool(get_param('count_nuclei', params))
+    processGraph, stepIndices = buildProcessGraph(
+        perChannelParamsList, scale, tripletsParams, touchingParams,
+        denoise=bool(get_param('do_denoising', params)),
+        countNuclei=countNuclei,
+        doMasking=bool(get_param('do_masking', params)))
+
+    def progressCallback(progress: int, stepName: str) -> None:
+        logger.info(f"{outStem}: {progress}% {stepName}")
+
+    result = runProcessGraph(processGraph, spotChannels + [cf.channel_nucleus()], None, logger, workerPool,
+                             progressCallback if logger.isEnabledFor(INFO) else None)
+    if result is None:
+        return None
+    stepOutputs, endOutputs = result
+    return gatherOutputs(
+        outStem, cf, scale, stepOutputs, endOutputs, stepIndices,
+        nucleusSlice=perChannelParamsList[3]['nucleus_slice'],
+        countNuclei=countNuclei,
+        findDoublets=tripletsParams['find_doublets'],
+        saveSpots=bool(get_param('save_spot_image', params)),
+        spotChannels=spotChannels)
+
+def runBatch(files: List[str], params: Dict, outputDir: str, workerPool: WorkerPool, logger: Logger,
+             shard: str = None) -> List[str]:
+    """
+    Process the files in order, decoding the next file and writing the outputs of the
+    previous one in the background, and record each file's completion.
+    Returns the files that failed.
+    """
+    digest = paramsDigest(params)
+    cacheDir = get_param('cache_dir', params)
+    cache = ChannelCache(cacheDir, int(get_param('cache_max_gb', params) * 1024**3)) if cacheDir else None
+    failed = []
+    pendingWrite = None
+
+    def finishWrite():
+        # only one file's outputs are written at a time, to bound memory use
+        nonlocal pendingWrite
+        if pendingWrite is not None:
+            fileWritten, future = pendingWrite
+            pendingWrite = None
+            try:
+                future.result()
+                writeCompletion(fileWritten, outputStem(fileWritten, outputDir), digest, shard)
+                print(f"Finished {fileWritten}")
+            except Exception as e:
+                print(f"Outputs for {fileWritten} could not be written.  Error was: {e}")
+                failed.append(fileWritten)
+
+    with ThreadPoolExecutor(max_workers=1) as prefetchExecutor, ThreadPoolExecutor(max_workers=1) as writeExecutor:
+        nextFile = prefetchExecutor.submit(openConfocalFile, files[0], params, cache) if files else None
+        try:
+            for idx, inputFile in enumerate(files):
+                try:
+                    cf = nextFile.result()
+                except Exception as e:
+                    print(f"Image file {inputFile} could not be opened.  Error was: {e}")
+                    cf = None
+                if idx + 1 < len(files):
+                    nextFile = prefetchExecutor.submit(openConfocalFile, files[idx + 1], params, cache)
+                if cf is None:
+                    failed.append(inputFile)
+                    continue
+                print(f"Processing {inputFile}")
+                try:
+                    outputArgs = processFile(cf, outputStem(inputFile, outputDir), params, workerPool, logger)
+                except Exception as e:
+                    # a bad file shouldn't stop the rest of the batch
+                    logger.info(f"Processing {inputFile} failed", exc_info=True)
+                    print(f"Processing {inputFile} failed.  Error was: {e!r}")
+                    failed.append(inputFile)
+                    continue
+                finally:
+                    del cf
+                    # the previous file's outputs were written while this one was processed
+                    finishWrite()
+                if outputArgs is None:
+                    print(f"Processing {inputFile} did not complete")
+                    failed.append(inputFile)
+                    continue
+                pendingWrite = (inputFile, writeExecutor.submit(writeOutputs, **outputArgs))
+        finally:
+            finishWrite()
+    return failed
+
+def mergeOutputs(files: List[str], outputDir: str, mergedStem: str, digest: str) -> Tuple[List[str], List[str]]:
+    """
+    Combine the _distances.csv and _results.txt outputs of the files into
+    mergedStem_distances.csv and mergedStem_results.csv, adding a first column
+    naming the input file.  Returns the files that haven't been completed, or whose
+    outputs are missing, and those completed with other params than digest, or that
+    have changed since, all of which are left out.  The merged files are written
+    under temporary names and renamed.
+    """
+    missing = []
+    stale = []
+    distancesPath = mergedStem + "_distances.csv"
+    resultsPath = mergedStem + "_results.csv"
+    with open(distancesPath + ".tmp", 'w', newline='') as distancesFile, \
+            open(resultsPath + ".tmp", 'w', newline='') as resultsFile:
+        distancesOut = csv.writer(distancesFile)
+        resultsOut = csv.writer(resultsFile)
+        resultsOut.writerow(['file', 'nucleusCount', 'X', 'Y', 'Z', 'conformation'])
+        wroteHeader = False
+        for inputFile in files:
+            outStem = outputStem(inputFile, outputDir)
+            if readCompletion(outStem) is None:
+                missing.append(inputFile)
+                continue
+            # read both outputs before writing anything, so that a file with an
+            # output missing since it was completed is left out altogether
+            try:
+                with open(outStem + "_distances.csv", 'r', newline='') as f:
+                    rows = list(csv.reader(f))
+                with open(outStem + "_results.txt", 'r') as f:
+                    resultLines = f.readlines()
+            except OSError:
+                missing.append(inputFile)
+                continue
+            if not rows:
+                missing.append(inputFile)
+                continue
+            if not isUpToDate(inputFile, outStem, digest):
+                stale.append(inputFile)
+                continue
+            if not wroteHeader:
+                distancesOut.writerow(['file'] + rows[0])
+                wroteHeader = True
+            for row in rows[1:]:
+                distancesOut.writerow([inputFile] + row)
+            nucleusCount = ''
+            for line in resultLines:
+                if line.startswith('Nucleus count:'):
+                    nucleusCount = line.split(':')[1].strip()
+                elif line.strip():
+                    resultsOut.writerow([inputFile, nucleusCount] + line.split())
+    os.replace(distancesPath + ".tmp", distancesPath)
+    os.replace(resultsPath + ".tmp", resultsPath)
+    return missing, stale
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Find spots in a batch of confocal files")
+    parser.add_argument('inputs', nargs='*', help=".czi files, directories of .czi files, or glob patterns")
+    parser.add_argument('-m', '--manifest', help="file listing more inputs, one per line")
+    parser.add_argument('-p', '--params', help="YAML file of processing params")
+    parser.add_argument('-o', '--output-dir', help="directory for the outputs, instead of next to each input")
+    parser.add_argument('-w', '--workers', type=workerCount, default=None,
+                        help="worker processes to use (default: 3/4 of the available CPUs, at least 2)")
+    parser.add_argument('-t', '--threads', type=threadCount, default=None,
+                        help="BLAS/OpenMP threads per worker (default: the available CPUs shared between the workers)")
+    parser.add_argument('--memory-gb', type=float, default=None,
+                        help="memory the workers' tasks may use between them (default: 3/4 of the available memory)")
+    parser.add_argument('-f', '--force', action='store_true', help="process files even if their outputs are up to date")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log the progress of every process step")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--shard', type=parseShard, default=None,
+                      help="process only shard K of N (default: from the SLURM array task, if any)")
+    mode.add_argument('--merge', metavar='STEM', help="merge the outputs of all the inputs instead of processing them")
+    args = parser.parse_args(argv)
+
+    params = {}
+    if args.params:
+        with open(args.params, 'r') as paramsFile:
+            params = yaml.safe_load(paramsFile) or {}
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    logger = mp.log_to_stderr()
+    logger.setLevel(INFO if args.verbose else WARNING)
+
+    inputs = args.inputs + (readManifest(args.manifest) if args.manifest else [])
+    if not inputs:
+        parser.error("no inputs given")
+    files = findInputFiles(inputs)
+    outStems = [outputStem(path, args.output_dir) for path in files]
+    if len(set(outStems)) < len(outStems):
+        # two inputs with the same name would overwrite each other's outputs
+        parser.error("some inputs would write to the same outputs; use separate output directories")
+
+    if args.merge:
+        missing, stale = mergeOutputs(files, args.output_dir, args.merge, paramsDigest(params))
+        for path in missing:
+            print(f"Not completed: {path}")
+        for path in stale:
+            print(f"Out of date, completed with other params or since changed: {path}")
+        print(f"Merged {len(files) - len(missing) - len(stale)} of {len(files)} files into "
+              f"{args.merge}_distances.csv and {args.merge}_results.csv")
+        return 1 if missing or stale else 0
+
+    shard = args.shard
+    if shard is None:
+        try:
+            shard = slurmShard()
+        except (ValueError, argparse.ArgumentTypeError) as e:
+            parser.error(str(e))
+    if shard:
+        # every shard sees the same sorted list, so each file lands in exactly one shard
+        files = files[shard[0]::shard[1]]
+        print(f"Shard {shard[0]}/{shard[1]}: {len(files)} files")
+    if not args.force:
+        digest = paramsDigest(params)
+        upToDate = [path for path in files if isUpToDate(path, outputStem(path, args.output_dir), digest)]
+        if upToDate:
+            print(f"Skipping {len(upToDate)} files with up to date outputs")
+        files = [path for path in files if path not in upToDate]
+    print(f"{len(files)} files to process")
+    if not files:
+        return 0
+
+    memoryBudget = int(args.memory_gb * 1024**3) if args.memory_gb else None
+    with WorkerPool(args.workers, preload=['algorithms.denoise', 'algorithms.detect_spots'],
+                    memoryBudget=memoryBudget, threadsPerWorker=args.threads) as workerPool:
+        print(f"Using {workerPool.processes} processes x {workerPool.threadsPerWorker} threads")
+        failed = runBatch(files, params, args.output_dir, workerPool, logger,
+                          f"{shard[0]}/{shard[1]}" if shard else None)
+    for path in failed:
+        print(f"Failed: {path}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    mp.set_start_method('spawn')
+    sys.exit(main(sys.argv[1:]))
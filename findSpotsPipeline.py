@@ -0,0 +1,308 @@
+# findSpotsPipeline.py
+
+"""
+The spot finding pipeline for one confocal file, shared by the FindSpotsTool GUI
+and the findSpotsBatch command line tool: building the sequence of process steps,
+running it, and writing the outputs.
+"""
+
+from algorithms.countNuclei import ProcessStepCountNuclei
+from algorithms.confocal_file import ConfocalFile
+from algorithms.denoise import ProcessStepDenoiseChannelsConcurrent
+from algorithms.threshold_mask import ProcessStepThresholdMask
+from algorithms.detect_spots import ProcessStepDetectSpotsConcurrent
+from algorithms.tripletDetection import ProcessStepFindTriplets, distanceSquared
+from algorithms.touchingAnalysis import ProcessStepAnalyzeTouching, write_output
+from spots_io.plot_spots import plot_spots_2D, plot_spots_3D
+from processing import ProcessNode, ProcessStatus, ProcessStep, ProcessStepGraph, WorkerPool
+
+from logging import Logger
+from math import nan, sqrt
+from matplotlib import cm
+import numpy as np
+import tifffile as tiff
+from typing import Callable, Dict, List, Tuple
+
+# the suffixes of the outputs that are written for every file, after the file's stem
+outputSuffixes = ["_distances.csv", "_results.txt", "_2D_rgb.tiff", "_3D_rgb.tiff"]
+
+def buildProcessSequence(perChannelParamsList: List[Dict], scale: Dict, tripletsParams: Dict,
+                         touchingParams: Dict, denoise: bool, countNuclei: bool, doMasking: bool,
+                         denoiseStep: ProcessStep = None) -> Tuple[List[ProcessStep], Tuple[int, int, int]]:
+    """
+    Build the sequence of process steps for one file.  perChannelParamsList holds the
+    params of the left, middle, right and nucleus channels, in that order.  denoiseStep
+    replaces the usual denoising step, which denoises all the channels together.
+
+    Returns the steps, and the indices of the count nuclei, detect spots and triplet
+    detection steps, whose endOutputs are needed to write the outputs.
+    """
+    nucleusChannelParams = perChannelParamsList[3]
+    processSequence: List = []
+
+    # Save the index of some specific process steps, so that we can get results specific
+    # to that step from endOutputs later
+    countNucleiStep: int = 0
+    detectSpotsStep: int = 0
+    tripletDetectionStep: int = 1   # doublets lists
+
+    if denoise:
+        if denoiseStep is None:
+            # denoise the slices (or bricks) of all the channels together, on one pool of workers
+            denoiseStep = ProcessStepDenoiseChannelsConcurrent(perChannelParamsList)
+        processSequence.append(denoiseStep)
+        # since we're adding a process step before CountNuclei and DetectSpots...
+        countNucleiStep += 1
+        detectSpotsStep += 1
+        tripletDetectionStep += 1
+
+    if countNuclei:
+        processSequence.append(ProcessStepCountNuclei(nucleusChannelParams))
+        # since we're adding a process step before DetectSpots...
+        detectSpotsStep += 1
+        tripletDetectionStep += 1
+
+    # Include the ThresholdMask process step regardless, since it needs to
+    # reduce the number of channels from four to three, but signal
+    # whether or not to actually do masking via the params
+    nucleusChannelParams['do_masking'] = doMasking
+    processSequence.append(ProcessStepThresholdMask(nucleusChannelParams))
+    # since we're adding a process step before DetectSpots...
+    detectSpotsStep += 1
+    tripletDetectionStep += 1
+
+    # Add the rest of the process steps that require no conditional processing
+    processSequence.extend([
+            ProcessStepDetectSpotsConcurrent(perChannelParamsList),
+            ProcessStepFindTriplets(scale, tripletsParams),
+            ProcessStepAnalyzeTouching(touchingParams)
+        ])
+    return processSequence, (countNucleiStep, detectSpotsStep, tripletDetectionStep)
+
+def buildProcessGraph(perChannelParamsList: List[Dict], scale: Dict, tripletsParams: Dict,
+                      touchingParams: Dict, denoise: bool, countNuclei: bool,
+                      doMasking: bool) -> Tuple[ProcessStepGraph, Tuple[str, str, str]]:
+    """
+    Build the same process steps as buildProcessSequence(), as a graph in which the
+    nucleus channel is denoised first and passed on as soon as it is done, so that
+    counting the nuclei can run while the spot channels are still being denoised.
+    Its inputs are the left, middle, right and nucleus channels, in that order.
+
+    Returns the graph, and the names of the count nuclei, detect spots and triplet
+    detection nodes, whose endOutputs are needed to write the outputs.
+    """
+    nucleusChannelParams = perChannelParamsList[3]
+    nodes: List[ProcessNode] = []
+    spots = ["left", "middle", "right"]
+    nucleus = ["nucleus"]
+
+    if denoise:
+        # one denoise keeps the workers busy across all the channels; the nucleus channel's
+        # tasks are queued first, since more steps are waiting for it
+        nodes.append(ProcessNode("denoise",
+                                 ProcessStepDenoiseChannelsConcurrent([nucleusChannelParams] + perChannelParamsList[:3]),
+                                 nucleus + spots,
+                                 ["denoisedNucleus", "denoisedLeft", "denoisedMiddle", "denoisedRight"]))
+        spots = ["denoisedLeft", "denoisedMiddle", "denoisedRight"]
+        nucleus = ["denoisedNucleus"]
+
+    if countNuclei:
+        nodes.append(ProcessNode("countNuclei", ProcessStepCountNuclei(nucleusChannelParams), nucleus, []))
+
+    # As in the sequence, ThresholdMask also drops the nucleus channel when there's no masking
+    nucleusChannelParams['do_masking'] = doMasking
+    nodes.extend([
+            ProcessNode("thresholdMask", ProcessStepThresholdMask(nucleusChannelParams),
+                        spots + nucleus, ["maskedSpots"]),
+            ProcessNode("detectSpots", ProcessStepDetectSpotsConcurrent(perChannelParamsList),
+                        ["maskedSpots"], ["spots"]),
+            ProcessNode("findTriplets", ProcessStepFindTriplets(scale, tripletsParams),
+                        ["spots"], ["triplets"]),
+            ProcessNode("analyzeTouching", ProcessStepAnalyzeTouching(touchingParams),
+                        ["triplets"], ["output"])
+        ])
+    graph = ProcessStepGraph(nodes, ["left", "middle", "right", "nucleus"], ["output"])
+    return graph, ("countNuclei", "detectSpots", "findTriplets")
+
+def runProcessGraph(graph: ProcessStepGraph, inputs: List, app, logger: Logger,
+                    workerPool: WorkerPool = None,
+                    progressCallback: Callable[[int, str], None] = None) -> Tuple[List, Dict]:
+    """
+    Run the graph on inputs.  Returns its stepOutputs and the dict of the endOutputs
+    of every step, or None if a step didn't complete.
+    """
+    graph.setApp(app)
+    graph.setLogger(logger)
+    graph.setWorkerPool(workerPool)
+    graph.setInputs(inputs)
+    graph.run(progressCallback)
+    if graph.status() != ProcessStatus.COMPLETED:
+        return None
+    return graph.stepOutputs(), graph.endOutputs()
+
+def runProcessSequence(processSequence: List[ProcessStep], inputs: List, app, logger: Logger,
+                       workerPool: WorkerPool = None,
+                       progressCallback: Callable[[int, str], None] = None) -> Tuple[List, List]:
+    """
+    Run the steps in order, each on the stepOutputs of the one before, starting from inputs.
+    Returns the last step's stepOutputs and a list of the endOutputs of every step,
+    or None if a step didn't complete.
+    """
+    stepOutputs = inputs
+    endOutputs = []
+    for step in processSequence:
+        step.setApp(app)
+        step.setLogger(logger)
+        step.setWorkerPool(workerPool)
+        step.setInputs(stepOutputs)
+        step.run(progressCallback)
+        if step.status() != ProcessStatus.COMPLETED:
+            return None
+        stepOutputs = step.stepOutputs()
+        endOutputs.append(step.endOutputs())
+    return stepOutputs, endOutputs
+
+def gatherOutputs(outStem: str, cf: ConfocalFile, scale: Dict, stepOutputs: List, endOutputs,
+                  stepIndices: Tuple, nucleusSlice: int, countNuclei: bool,
+                  findDoublets: bool, saveSpots: bool, spotChannels: List) -> Dict:
+    """
+    Pick the results out of the outputs of runProcessSequence() or runProcessGraph(),
+    as the arguments of writeOutputs().  stepIndices are the step indices or node names
+    returned with the sequence or graph.
+    """
+    countNucleiStep, detectSpotsStep, tripletDetectionStep = stepIndices
+    nucleusCoords, nucleusCountImage = endOutputs[countNucleiStep] if countNuclei else (None, None)
+    triplets, leftDoublets, rightDoublets, leftRightDoublets = endOutputs[tripletDetectionStep]
+    if isinstance(endOutputs, dict):
+        saveSpots = saveSpots and detectSpotsStep in endOutputs
+    else:
+        saveSpots = saveSpots and len(endOutputs) > detectSpotsStep
+    return {
+        'outStem': outStem,
+        'cf': cf,
+        'scale': scale,
+        'output': stepOutputs[0],
+        'triplets': triplets,
+        'leftDoublets': leftDoublets,
+        'rightDoublets': rightDoublets,
+        'leftRightDoublets': leftRightDoublets,
+        'nucleusCoords': nucleusCoords,
+        'nucleusCountImage': nucleusCountImage,
+        'nucleusSlice': nucleusSlice,
+        'countNuclei': countNuclei,
+        'findDoublets': findDoublets,
+        'spots': endOutputs[detectSpotsStep] if saveSpots else None,
+        'spotChannels': spotChannels
+    }
+
+def write_distances(triplets, leftDoublets, rightDoublets, leftRigthDoublets, outName):
+    """
+    Write out the distances and the coordinates
+    Order inside the triplet is {left, middle, right}
+    """
+    with open(outName, "w") as f:
+        f.write("Xleft,Yleft,Zleft,Xmiddle,Ymiddle,Zmiddle,Xright,Yright,Zright,leftDist,rightDist,leftRightDist\n")
+        for triplet in triplets:
+            leftDist = sqrt(distanceSquared(triplet[0], triplet[1]))
+            rightDist = sqrt(distanceSquared(triplet[1], triplet[2]))
+            leftRightDist = sqrt(distanceSquared(triplet[0], triplet[2]))
+            f.write(f"{triplet[0][0]},{triplet[0][1]},{triplet[0][2]}," +
+                    f"{triplet[1][0]},{triplet[1][1]},{triplet[1][2]}," +
+                    f"{triplet[2][0]},{triplet[2][1]},{triplet[2][2]}," +
+                    f"{leftDist},{rightDist},{leftRightDist}\n")
+        for leftDoublet in leftDoublets:
+            leftDist = sqrt(distanceSquared(leftDoublet[0], leftDoublet[1]))
+            f.write(f"{leftDoublet[0][0]},{leftDoublet[0][1]},{leftDoublet[0][2]}," +
+                    f"{leftDoublet[1][0]},{leftDoublet[1][1]},{leftDoublet[1][2]}," +
+                    f"{nan},{nan},{nan}," +
+                    f"{leftDist},{nan},{nan}\n")
+        for rightDoublet in rightDoublets:
+            rightDist = sqrt(distanceSquared(rightDoublet[0], rightDoublet[1]))
+            f.write(f"{nan},{nan},{nan}," +
+                    f"{rightDoublet[0][0]},{rightDoublet[0][1]},{rightDoublet[0][2]}," +
+                    f"{rightDoublet[1][0]},{rightDoublet[1][1]},{rightDoublet[1][2]}," +
+                    f"{nan},{rightDist},{nan}\n")
+        for leftRightDoublet in leftRigthDoublets:
+            leftRightDist = sqrt(distanceSquared(leftRightDoublet[0], leftRightDoublet[1]))
+            f.write(f"{leftRightDoublet[0][0]},{leftRightDoublet[0][1]},{leftRightDoublet[0][2]}," +
+                    f"{nan},{nan},{nan}," +
+                    f"{leftRightDoublet[1][0]},{leftRightDoublet[1][1]},{leftRightDoublet[1][2]}," +
+                    f"{nan},{nan},{leftRightDist}\n")
+
+def writeOutputs(outStem: str, cf: ConfocalFile, scale: Dict, output: List,
+                 triplets: List, leftDoublets: List, rightDoublets: List, leftRightDoublets: List,
+                 nucleusCoords: List, nucleusCountImage: np.ndarray, nucleusSlice: int,
+                 countNuclei: bool, findDoublets: bool, spots: List, spotChannels: List) -> None:
+    """
+    Write the results of one file, and render and write its images.
+    This doesn't touch the UI, so that it can run on a background thread.
+    The outputs are named by adding suffixes to outStem.
+    """
+    write_distances(triplets, leftDoublets, rightDoublets, leftRightDoublets, outStem + "_distances.csv")
+    write_output(output, outStem + "_results.txt", len(nucleusCoords) if nucleusCoords else None)
+
+    # construct a new rgb version of the nucleus image volume and specified slice
+    spot_projection_slice = max(0, min(nucleusSlice, cf.channel_nucleus().shape[0] - 1))
+    gray_colormap = cm.get_cmap('gray', 256)
+    nucleus_3D_rgb = gray_colormap(cf.channel_nucleus(), bytes=True)[:,:,:,0:3]
+    nucleus_2D_rgb = gray_colormap(cf.channel_nucleus()[spot_projection_slice], bytes=True)[:,:,0:3]
+
+    # For now, always plot nuclei if we counted them
+    if countNuclei:
+        nuclei_2d_rgb = gray_colormap(nucleusCountImage, bytes=True)[:,:,0:3]
+        plot_spots_2D(nuclei_2d_rgb, nucleusCoords, (1., 1., 1.), lambda pos: [255, 255, 0])
+        tiff.imwrite(outStem + "_nuclei_rgb.tiff", nuclei_2d_rgb)
+
+    # Now plot each of the triplets into the image stack, colored by conformation
+    colors = {
+        '000': ( 64,  64,  64),     # nothing touching: dark gray
+        '100': (255, 255,   0),     # only red touching green: yellow
+        '010': (  0, 255, 255),     # only green touching blue: cyan
+        '001': (255,   0, 255),     # only blue touching red: magenta
+        '110': (  0, 255,   0),     # red touching green, and green touching blue: green
+        '011': (  0,   0, 255),     # green touching blue and blue touching red: blue
+        '101': (255,   0,   0),     # blue touching red and red touching green: red
+        '111': (255, 255, 255)      # all spots touching: white
+        }
+    scaleTuple = (scale['X'], scale['Y'], scale['Z'])
+    plot_spots_2D(nucleus_2D_rgb, output, scaleTuple, lambda pos: colors[pos[3]])
+    tiff.imwrite(outStem + "_2D_rgb.tiff", nucleus_2D_rgb)
+
+    plot_spots_3D(nucleus_3D_rgb, output, scaleTuple, lambda pos: colors[pos[3]])
+    tiff.imwrite(outStem + "_3D_rgb.tiff", nucleus_3D_rgb)
+
+    if findDoublets:
+        doublet_2D_rgb = gray_colormap(cf.channel_nucleus()[spot_projection_slice], bytes=True)[:,:,0:3]
+        # Calculate the left doublet centroids
+        leftDoubletCentroids = [((doublet[0][0] + doublet[1][0])/2.,
+                                 (doublet[0][1] + doublet[1][0])/2.,
+                                 (doublet[0][2] + doublet[1][2])/2.) for doublet in leftDoublets]
+        # Plot the left doublet centroids in red
+        plot_spots_2D(doublet_2D_rgb, leftDoubletCentroids, scaleTuple, lambda pos: (255, 0, 0))
+        # Calculate the right doublet centroids
+        rightDoubletCentroids = [((doublet[0][0] + doublet[1][0])/2.,
+                                  (doublet[0][1] + doublet[1][0])/2.,
+                                  (doublet[0][2] + doublet[1][2])/2.) for doublet in rightDoublets]
+        # Plot the right doublet centroids in blue on the same image as the left doublets
+        plot_spots_2D(doublet_2D_rgb, rightDoubletCentroids, scaleTuple, lambda pos: (0, 0, 255))
+        tiff.imwrite(outStem + "_doublets_rgb.tiff", doublet_2D_rgb)
+
+    if spots:
+        spotColors = [
+            (255,   0,   0),     # red
+            (  0, 255,   0),     # green
+            (  0,   0, 255)      # blue
+        ]
+
+        spots_2D_rgb = gray_colormap(cf.channel_nucleus()[spot_projection_slice], bytes=True)[:,:,0:3]
+        spots_3D_rgb = gray_colormap(cf.channel_nucleus(), bytes=True)[:,:,:,0:3]
+
+        spotsScale = (1., 1., 1.)
+        for ix, ch in enumerate(spotChannels):
+            spots_image = gray_colormap(ch, bytes=True)[:,:,:,0:3]
+            plot_spots_2D(spots_2D_rgb, spots[ix], spotsScale, lambda pos: spotColors[ix], filled=False)
+            plot_spots_3D(spots_3D_rgb, spots[ix], spotsScale, lambda pos: spotColors[ix], filled=False)
+            plot_spots_3D(spots_image, spots[ix], spotsScale, lambda pos: spotColors[ix], filled=False)
+            tiff.imwrite(outStem + f"_ch{ix}_spots.tiff", spots_image)
+        tiff.imwrite(outStem + "_spots_3D_rgb.tiff", spots_3D_rgb)
+        tiff.imwrite(outStem + "_spots_rgb.tiff", spots_2D_rgb)
@@ -2,28 +2,23 @@
 from qtpy.QtCore import QStringListModel, Signal, Slot
 from qtpy.QtWidgets import QApplication, QFileDialog, QMainWindow, QMessageBox
 from findSpotsTool_ui import Ui_MainWindow
-from algorithms.countNuclei import ProcessStepCountNuclei
 from algorithms.denoise import ProcessStepDenoiseConcurrent
-from algorithms.threshold_mask import ProcessStepThresholdMask
-from algorithms.detect_spots import ProcessStepDetectSpotsConcurrent
-from algorithms.tripletDetection import ProcessStepFindTriplets, distanceSquared
-from algorithms.touchingAnalysis import ProcessStepAnalyzeTouching, write_output
 from algorithms.find_spots import get_param
+from algorithms.channel_cache import ChannelCache
 from algorithms.confocal_file import ConfocalFile
-from spots_io.plot_spots import plot_spots_2D, plot_spots_3D
-from processing import ProcessStatus, ProcessStepIterate
+from findSpotsPipeline import buildProcessGraph, buildProcessSequence, gatherOutputs, runProcessGraph, \
+    runProcessSequence, writeOutputs
+from processing import ProcessStepIterate, WorkerPool
 from imageCompareDialog import ProcessStepVisualizeDenoise
 
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from logging import INFO
-from math import sqrt
-from matplotlib import cm
 import multiprocessing as mp
-import numpy as np
-from math import nan
 from os.path import expanduser, splitext
 import sys, platform
-import tifffile as tiff
-from typing import Dict, List
+import yaml
+from typing import Dict
 
 class FindSpotsTool(QMainWindow):
 
@@ -33,11 +28,12 @@ class FindSpotsTool(QMainWindow):
     testSettingsPipeline = [
         (ProcessStepDenoiseConcurrent, [])
     ]
-    def __init__(self, app: QApplication):
+    def __init__(self, app: QApplication, params: Dict = {}):
         super().__init__()
 
         self._app = app
         self._logger = None
+        self._workerPool = None
 
         # set up the main window UI
         self.ui = Ui_MainWindow()
@@ -53,8 +49,17 @@ class FindSpotsTool(QMainWindow):
 
         # initialize parameters
         # For now, we don't support saving of params.
+        # params can be loaded from a YAML file given on the command line, as for findSpotsBatch.py;
         # defaults come from the default_params dict initialized in find_spots.py
-        params = {}
+        self.channelCache = None
+        self.setCacheParams(params)
+
+        # Batch runs can decode the next file and write the last file's outputs in the background
+        self._pipelineBatch = bool(get_param('pipeline_batch', params))
+        self._prefetchExecutor = ThreadPoolExecutor(max_workers=1)
+        self._writeExecutor = ThreadPoolExecutor(max_workers=1)
+        self._prefetched = None
+        self._pendingWrite = None
 
         # Initialize dynamic UI contents and connect UI widget Signals to Slots
         # Slice Selection Settings:
@@ -132,9 +137,21 @@ class FindSpotsTool(QMainWindow):
         # setup some state
         self.running: bool = False
 
+    def setCacheParams(self, params: Dict) -> None:
+        """
+        Set up the optional cache of decoded channels from the cache_dir and cache_max_gb
+        params, so re-opening a file while tuning parameters is fast.  Files already
+        opened keep the cache they were opened with.
+        """
+        cacheDir = get_param('cache_dir', params)
+        self.channelCache = ChannelCache(cacheDir, int(get_param('cache_max_gb', params) * 1024**3)) if cacheDir else None
+
     def setLogger(self, logger):
         self._logger = logger
 
+    def setWorkerPool(self, workerPool: WorkerPool):
+        self._workerPool = workerPool
+
     @Slot()
     def changeDenoiseEnableState(self):
         for widget in [self.ui.use3DCheckBox,
@@ -184,48 +201,71 @@ class FindSpotsTool(QMainWindow):
 
     @Slot(bool)
     def runBatch(self, checked: bool = False):
+        if self.running:
+            # clicked again while Qt events were processed during a run
+            return
         while len(self.pendingFilesModel.stringList()) > 0:
-            self.processNextFile(False)
+            self.processNextFile(False, self._pipelineBatch)
+        self.waitForWrite()
+
+    def waitForFuture(self, future: Future):
+        """
+        Wait for a background task, letting Qt handle UI events meanwhile,
+        and return its result
+        """
+        while len(wait([future], timeout=0.1).done) == 0:
+            self._app.processEvents()
+        return future.result()
+
+    def waitForWrite(self) -> None:
+        """
+        Wait for the background write of the last file's outputs, if there is one
+        """
+        if self._pendingWrite is None:
+            return
+        fileWritten, future = self._pendingWrite
+        self._pendingWrite = None
+        try:
+            self.waitForFuture(future)
+        except Exception as e:
+            QMessageBox.warning(self, "Write Failed", f"Outputs for {fileWritten} could not be written.  Error was: {e}")
 
-    def write_distances(self, triplets, leftDoublets, rightDoublets, leftRigthDoublets, outName):
+    def openConfocalFile(self, fileName: str, firstSlice: int, lastSlice: int) -> ConfocalFile:
         """
-        Write out the distances and the coordinates
-        Order inside the triplet is {left, middle, right}
+        Open a confocal file, decoding the selected slices, or take it from the
+        prefetch started for it while the previous file of a batch was processed
+        """
+        prefetched, self._prefetched = self._prefetched, None
+        if prefetched is not None and prefetched[0] == (fileName, firstSlice, lastSlice):
+            return self.waitForFuture(prefetched[1])
+        return ConfocalFile(fileName, firstSlice=firstSlice, lastSlice=lastSlice, cache=self.channelCache)
+
+    def prefetch(self, fileName: str, firstSlice: int, lastSlice: int) -> None:
         """
-        with open(outName, "w") as f:
-            f.write("Xleft,Yleft,Zleft,Xmiddle,Ymiddle,Zmiddle,Xright,Yright,Zright,leftDist,rightDist,leftRightDist\n")
-            for triplet in triplets:
-                leftDist = sqrt(distanceSquared(triplet[0], triplet[1]))
-                rightDist = sqrt(distanceSquared(triplet[1], triplet[2]))
-                leftRightDist = sqrt(distanceSquared(triplet[0], triplet[2]))
-                f.write(f"{triplet[0][0]},{triplet[0][1]},{triplet[0][2]}," +
-                        f"{triplet[1][0]},{triplet[1][1]},{triplet[1][2]}," +
-                        f"{triplet[2][0]},{triplet[2][1]},{triplet[2][2]}," +
-                        f"{leftDist},{rightDist},{leftRightDist}\n")
-            for leftDoublet in leftDoublets:
-                leftDist = sqrt(distanceSquared(leftDoublet[0], leftDoublet[1]))
-                f.write(f"{leftDoublet[0][0]},{leftDoublet[0][1]},{leftDoublet[0][2]}," +
-                        f"{leftDoublet[1][0]},{leftDoublet[1][1]},{leftDoublet[1][2]}," +
-                        f"{nan},{nan},{nan}," +
-                        f"{leftDist},{nan},{nan}\n")
-            for rightDoublet in rightDoublets:
-                rightDist = sqrt(distanceSquared(rightDoublet[0], rightDoublet[1]))
-                f.write(f"{nan},{nan},{nan}," +
-                        f"{rightDoublet[0][0]},{rightDoublet[0][1]},{rightDoublet[0][2]}," +
-                        f"{rightDoublet[1][0]},{rightDoublet[1][1]},{rightDoublet[1][2]}," +
-                        f"{nan},{rightDist},{nan}\n")
-            for leftRightDoublet in leftRigthDoublets:
-                leftRightDist = sqrt(distanceSquared(leftRightDoublet[0], leftRightDoublet[1]))
-                f.write(f"{leftRightDoublet[0][0]},{leftRightDoublet[0][1]},{leftRightDoublet[0][2]}," +
-                        f"{nan},{nan},{nan}," +
-                        f"{leftRightDoublet[1][0]},{leftRightDoublet[1][1]},{leftRightDoublet[1][2]}," +
-                        f"{nan},{nan},{leftRightDist}\n")
-
-    def processNextFile(self, validateParams: bool) -> None:
+        Start opening and decoding a file in the background, for openConfocalFile()
+        """
+        future = self._prefetchExecutor.submit(
+            ConfocalFile, fileName, firstSlice=firstSlice, lastSlice=lastSlice, cache=self.channelCache)
+        self._prefetched = ((fileName, firstSlice, lastSlice), future)
+
+    def processNextFile(self, validateParams: bool, pipelined: bool = False) -> None:
+        # Qt events are processed while the steps run, so a button may be clicked
+        # again; the steps and the worker pool can only run one file at a time
+        if self.running:
+            return
+        self.running = True
+        try:
+            self.runNextFile(validateParams, pipelined)
+        finally:
+            self.running = False
+
+    def runNextFile(self, validateParams: bool, pipelined: bool) -> None:
         # There may be a file currently being processed, where the user
         # rejected the params for one of the process steps.  We need to
         # restart processing that file with the process step that was
         # rejected.
+        # If pipelined, the next pending file is decoded and this file's
+        # outputs are written in the background, while the steps run.
 
         def progressCallback(progress: int, stepName: str) -> None:
             self.noteProgressChanged.emit(progress, stepName)
@@ -233,20 +273,25 @@ class FindSpotsTool(QMainWindow):
         fileToRun = self.ui.activeFileLineEdit.text()
         if fileToRun == None or fileToRun == "" or fileToRun == self.fileNameNone:
             pendingFilesList = self.pendingFilesModel.stringList()
-            if self.running or len(pendingFilesList) == 0:
+            if len(pendingFilesList) == 0:
                 return
             fileToRun = pendingFilesList[0]
             self.ui.activeFileLineEdit.setText(fileToRun)
             pendingFilesList = pendingFilesList[1:]
             self.pendingFilesModel.setStringList(pendingFilesList)
 
-        # open confocal file and get image
+        # open confocal file and get image, decoding only the selected slices
+        firstSlice = int(self.ui.firstSliceLineEdit.text())
+        lastSlice = int(self.ui.lastSliceLineEdit.text())
         try:
-            cf = ConfocalFile(fileToRun)
+            cf = self.openConfocalFile(fileToRun, firstSlice, lastSlice)
         except Exception as e:
             QMessageBox.warning(self, "Invalid File", f"Image file {fileToRun} could not be opened.  Error was: {e}")
             return
         scale = cf.get_scale()
+        pendingFilesList = self.pendingFilesModel.stringList()
+        if pipelined and len(pendingFilesList) > 0:
+            self.prefetch(pendingFilesList[0], firstSlice, lastSlice)
 
         # set up the progress bar
         self.ui.progressBar.setMinimum(0)
@@ -257,8 +302,8 @@ class FindSpotsTool(QMainWindow):
 
         # params for the left channel
         leftChannelParams = {
-            'firstSlice': int(self.ui.firstSliceLineEdit.text()),
-            'lastSlice': int(self.ui.lastSliceLineEdit.text()),
+            'firstSlice': 0,    # cf already holds only the selected slices
+            'lastSlice': -1,
             'sigma': int(self.ui.leftSigmaLineEdit.text()),
             'sharpen': float(self.ui.leftSharpenLineEdit.text()),
             'spot_detect_threshold': float(self.ui.leftSpotDetectionThresholdLineEdit.text()),
@@ -266,8 +311,8 @@ class FindSpotsTool(QMainWindow):
         }
         # params for the middle channel
         middleChannelParams = {
-            'firstSlice': int(self.ui.firstSliceLineEdit.text()),
-            'lastSlice': int(self.ui.lastSliceLineEdit.text()),
+            'firstSlice': 0,    # cf already holds only the selected slices
+            'lastSlice': -1,
             'sigma': int(self.ui.middleSigmaLineEdit.text()),
             'sharpen': float(self.ui.middleSharpenLineEdit.text()),
             'spot_detect_threshold': float(self.ui.middleSpotDetectionThresholdLineEdit.text()),
@@ -275,8 +320,8 @@ class FindSpotsTool(QMainWindow):
         }
         # params for the right channel
         rightChannelParams = {
-            'firstSlice': int(self.ui.firstSliceLineEdit.text()),
-            'lastSlice': int(self.ui.lastSliceLineEdit.text()),
+            'firstSlice': 0,    # cf already holds only the selected slices
+            'lastSlice': -1,
             'sigma': int(self.ui.rightSigmaLineEdit.text()),
             'sharpen': float(self.ui.rightSharpenLineEdit.text()),
             'spot_detect_threshold': float(self.ui.rightSpotDetectionThresholdLineEdit.text()),
@@ -284,13 +329,13 @@ class FindSpotsTool(QMainWindow):
         }
         # params for Nucleus channel
         nucleusChannelParams = {
-            'firstSlice': int(self.ui.firstSliceLineEdit.text()),
-            'lastSlice': int(self.ui.lastSliceLineEdit.text()),
+            'firstSlice': 0,    # cf already holds only the selected slices
+            'lastSlice': -1,
             'sigma': int(self.ui.sigmaNucleusLineEdit.text()),
             'sharpen': float(self.ui.sharpenNucleusLineEdit.text()),
             'nucleus_mask_threshold': float(self.ui.nucleusMaskingThresholdLineEdit.text()),
             'count_nuclei': bool(self.ui.countNucleiCheckBox.isChecked()),
-            'nucleus_slice': int(self.ui.nucleusSliceLineEdit.text())
+            'nucleus_slice': int(self.ui.nucleusSliceLineEdit.text()) - max(0, firstSlice)
         }
 
         tripletsParams: Dict = {
@@ -329,145 +374,57 @@ class FindSpotsTool(QMainWindow):
         # Nucleus counting process step is still included in the sequence if it's active.
 
         perChannelParamsList = [leftChannelParams, middleChannelParams, rightChannelParams, nucleusChannelParams]
+        for channelParams in perChannelParamsList:
+            channelParams['use_denoise3d'] = self.ui.use3DCheckBox.isChecked()
         stepOutputs = [channelItemFromString[self.ui.leftChannelComboBox.currentText()],
                        channelItemFromString[self.ui.middleChannelComboBox.currentText()],
                        channelItemFromString[self.ui.rightChannelComboBox.currentText()],
                        cf.channel_nucleus()]
 
-        processSequence: List = []
-
-        # Save the index of some specific process steps, so that we can get results specific
-        # to that step from endOutputs later
-        countNucleiStep: int = 0
-        detectSpotsStep: int = 0
-        tripletDetectionStep: int = 1   # doublets lists
-
-        #
-        # Build the sequence of process steps, based on what is selected in the UI and whether we're validating params or not
-        if self.ui.denoiseCheckBox.isChecked():
-            if validateParams:
-                processSequence.append(ProcessStepIterate(ProcessStepVisualizeDenoise, perChannelParamsList))
-            else:
-                processSequence.append(ProcessStepIterate(ProcessStepDenoiseConcurrent, perChannelParamsList))
-            # since we're adding a process step before CountNuclei and DetectSpots...
-            countNucleiStep += 1
-            detectSpotsStep += 1
-            tripletDetectionStep += 1
-
-        if self.ui.countNucleiCheckBox.isChecked():
-            processSequence.append(ProcessStepCountNuclei(nucleusChannelParams))
-            # since we're adding a process step before DetectSpots...
-            detectSpotsStep += 1
-            tripletDetectionStep += 1
-
-        # Include the ThresholdMask process step regardless, since it needs to
-        # reduce the number of channels from four to three, but signal
-        # whether or not to actually do masking via the params
-        nucleusChannelParams['do_masking'] = self.ui.maskingCheckBox.isChecked()
-        processSequence.append(ProcessStepThresholdMask(nucleusChannelParams))
-        # since we're adding a process step before DetectSpots...
-        detectSpotsStep += 1
-        tripletDetectionStep += 1
-
-        # Add the rest of the process steps that require no conditional processing
-        processSequence.extend([
-                ProcessStepDetectSpotsConcurrent(perChannelParamsList),
-                ProcessStepFindTriplets(scale, tripletsParams),
-                ProcessStepAnalyzeTouching(touchingParams)
-            ])
-
-        endOutputs = []
-        for step in processSequence:
-            step.setApp(self._app)
-            step.setLogger(self._logger)
-            step.setInputs(stepOutputs)
-            step.run(progressCallback)
-            if step.status() != ProcessStatus.COMPLETED:
-                msgBox = QMessageBox()
-                msgBox.exec()
-                return
-            stepOutputs = step.stepOutputs()
-            endOutputs.append(step.endOutputs())
-        output = stepOutputs[0]
-        conformance = endOutputs[-1][0]
-        nucleusCoords, nucleusCountImage = endOutputs[countNucleiStep] if self.ui.countNucleiCheckBox.isChecked() else (None, None)
-        triplets, leftDoublets, rightDoublets, leftRightDoublets = endOutputs[tripletDetectionStep]
+        if validateParams:
+            # the denoising is shown to the user to accept, which has to happen on
+            # this thread, so run the steps in sequence
+            processSequence, stepIndices = buildProcessSequence(
+                perChannelParamsList, scale, tripletsParams, touchingParams,
+                denoise=self.ui.denoiseCheckBox.isChecked(),
+                countNuclei=self.ui.countNucleiCheckBox.isChecked(),
+                doMasking=self.ui.maskingCheckBox.isChecked(),
+                denoiseStep=ProcessStepIterate(ProcessStepVisualizeDenoise, perChannelParamsList))
+            result = runProcessSequence(processSequence, stepOutputs, self._app, self._logger,
+                                        self._workerPool, progressCallback)
+        else:
+            processGraph, stepIndices = buildProcessGraph(
+                perChannelParamsList, scale, tripletsParams, touchingParams,
+                denoise=self.ui.denoiseCheckBox.isChecked(),
+                countNuclei=self.ui.countNucleiCheckBox.isChecked(),
+                doMasking=self.ui.maskingCheckBox.isChecked())
+            result = runProcessGraph(processGraph, stepOutputs, self._app, self._logger,
+                                     self._workerPool, progressCallback)
+        if result is None:
+            msgBox = QMessageBox()
+            msgBox.exec()
+            return
+        stepOutputs, endOutputs = result
 
         outStem, _ = splitext(fileToRun)
-        self.write_distances(triplets, leftDoublets, rightDoublets, leftRightDoublets, outStem + "_distances.csv")
-        write_output(output, outStem + "_results.txt", len(nucleusCoords) if nucleusCoords else None)
-
-        # construct a new rgb version of the nucleus image volume and specified slice
-        spot_projection_slice = int(self.ui.nucleusSliceLineEdit.text())
-        spot_projection_slice = max(0, min(spot_projection_slice, cf.channel_nucleus().shape[0]))
-        gray_colormap = cm.get_cmap('gray', 256)
-        nucleus_3D_rgb = gray_colormap(cf.channel_nucleus(), bytes=True)[:,:,:,0:3]
-        nucleus_2D_rgb = gray_colormap(cf.channel_nucleus()[spot_projection_slice], bytes=True)[:,:,0:3]
-
-        # For now, always plot nuclei if we counted them
-        if self.ui.countNucleiCheckBox.isChecked():
-            nuclei_2d_rgb = gray_colormap(nucleusCountImage, bytes=True)[:,:,0:3]
-            plot_spots_2D(nuclei_2d_rgb, nucleusCoords, (1., 1., 1.), lambda pos: [255, 255, 0])
-            tiff.imwrite(outStem + "_nuclei_rgb.tiff", nuclei_2d_rgb)
-
-        # Now plot each of the triplets into the image stack, colored by conformation
-        colors = {
-            '000': ( 64,  64,  64),     # nothing touching: dark gray
-            '100': (255, 255,   0),     # only red touching green: yellow
-            '010': (  0, 255, 255),     # only green touching blue: cyan
-            '001': (255,   0, 255),     # only blue touching red: magenta
-            '110': (  0, 255,   0),     # red touching green, and green touching blue: green
-            '011': (  0,   0, 255),     # green touching blue and blue touching red: blue
-            '101': (255,   0,   0),     # blue touching red and red touching green: red
-            '111': (255, 255, 255)      # all spots touching: white
-            }
-        scaleTuple = (scale['X'], scale['Y'], scale['Z'])
-        plot_spots_2D(nucleus_2D_rgb, output, scaleTuple, lambda pos: colors[pos[3]])
-        tiff.imwrite(outStem + "_2D_rgb.tiff", nucleus_2D_rgb)
-
-        plot_spots_3D(nucleus_3D_rgb, output, scaleTuple, lambda pos: colors[pos[3]])
-        tiff.imwrite(outStem + "_3D_rgb.tiff", nucleus_3D_rgb)
-
-        if self.ui.findDoubletsCheckBox.isChecked():
-            doublet_2D_rgb = gray_colormap(cf.channel_nucleus()[spot_projection_slice], bytes=True)[:,:,0:3]
-            # Calculate the left doublet centroids
-            leftDoubletCentroids = [((doublet[0][0] + doublet[1][0])/2.,
-                                     (doublet[0][1] + doublet[1][0])/2.,
-                                     (doublet[0][2] + doublet[1][2])/2.) for doublet in leftDoublets]
-            # Plot the left doublet centroids in red
-            plot_spots_2D(doublet_2D_rgb, leftDoubletCentroids, scaleTuple, lambda pos: (255, 0, 0))
-            # Calculate the right doublet centroids
-            rightDoubletCentroids = [((doublet[0][0] + doublet[1][0])/2.,
-                                      (doublet[0][1] + doublet[1][0])/2.,
-                                      (doublet[0][2] + doublet[1][2])/2.) for doublet in rightDoublets]
-            # Plot the right doublet centroids in blue on the same image as the left doublets
-            plot_spots_2D(doublet_2D_rgb, rightDoubletCentroids, scaleTuple, lambda pos: (0, 0, 255))
-            tiff.imwrite(outStem + "_doublets_rgb.tiff", doublet_2D_rgb)
-
-        if self.ui.saveDetectedSpotsCheckBox.isChecked() and len(endOutputs) > detectSpotsStep and endOutputs[detectSpotsStep]:
-            spots = endOutputs[detectSpotsStep]
-            spotColors = [
-                (255,   0,   0),     # red
-                (  0, 255,   0),     # green
-                (  0,   0, 255)      # blue
-            ]
-
-            spots_2D_rgb = gray_colormap(cf.channel_nucleus()[spot_projection_slice], bytes=True)[:,:,0:3]
-            spots_3D_rgb = gray_colormap(cf.channel_nucleus(), bytes=True)[:,:,:,0:3]
-
-            spotsScale = (1., 1., 1.)
-            for ix, ch in enumerate([
-                    channelItemFromString[self.ui.leftChannelComboBox.currentText()],
-                    channelItemFromString[self.ui.middleChannelComboBox.currentText()],
-                    channelItemFromString[self.ui.rightChannelComboBox.currentText()]
-                    ]):
-                spots_image = gray_colormap(ch, bytes=True)[:,:,:,0:3]
-                plot_spots_2D(spots_2D_rgb, spots[ix], spotsScale, lambda pos: spotColors[ix], filled=False)
-                plot_spots_3D(spots_3D_rgb, spots[ix], spotsScale, lambda pos: spotColors[ix], filled=False)
-                plot_spots_3D(spots_image, spots[ix], spotsScale, lambda pos: spotColors[ix], filled=False)
-                tiff.imwrite(outStem + f"_ch{ix}_spots.tiff", spots_image)
-            tiff.imwrite(outStem + "_spots_3D_rgb.tiff", spots_3D_rgb)
-            tiff.imwrite(outStem + "_spots_rgb.tiff", spots_2D_rgb)
+        outputArgs = gatherOutputs(
+            outStem, cf, scale, stepOutputs, endOutputs, stepIndices,
+            nucleusSlice=nucleusChannelParams['nucleus_slice'],
+            countNuclei=self.ui.countNucleiCheckBox.isChecked(),
+            findDoublets=self.ui.findDoubletsCheckBox.isChecked(),
+            saveSpots=self.ui.saveDetectedSpotsCheckBox.isChecked(),
+            spotChannels=[
+                channelItemFromString[self.ui.leftChannelComboBox.currentText()],
+                channelItemFromString[self.ui.middleChannelComboBox.currentText()],
+                channelItemFromString[self.ui.rightChannelComboBox.currentText()]
+            ])
+        if pipelined:
+            # Only one file's outputs are written at a time, so that no more
+            # than three files (previous, current and next) are held in memory
+            self.waitForWrite()
+            self._pendingWrite = (fileToRun, self._writeExecutor.submit(writeOutputs, **outputArgs))
+        else:
+            writeOutputs(**outputArgs)
 
         completedFilesList = self.completedFilesModel.stringList()
         completedFilesList.append(fileToRun)
@@ -475,7 +432,6 @@ class FindSpotsTool(QMainWindow):
         self.progressChanged(0, "")
         self.ui.progressBar.reset()
         self.completedFilesModel.setStringList(completedFilesList)
-        self.running = False
 
     @Slot(int, str)
     def progressChanged(self, progress: int, stepName: str) -> None:
@@ -493,13 +449,24 @@ class FindSpotsTool(QMainWindow):
 if __name__ == "__main__":
     if True or platform.system() == "Darwin":
         mp.set_start_method('spawn')
+    parser = argparse.ArgumentParser(description="Find spots in confocal files")
+    parser.add_argument('-p', '--params', help="YAML file of processing params, as for findSpotsBatch.py")
+    args, qtArgs = parser.parse_known_args()
+    params = {}
+    if args.params:
+        with open(args.params, 'r') as paramsFile:
+            params = yaml.safe_load(paramsFile) or {}
     # Create the Qt Application
-    app = QApplication(sys.argv)
+    app = QApplication(sys.argv[:1] + qtArgs)
 
-    tool = FindSpotsTool(app)
+    tool = FindSpotsTool(app, params)
     logger = mp.log_to_stderr()
     logger.setLevel(INFO)
     tool.setLogger(logger)
+    # Start the worker processes once for the session, with the BM4D library
+    # and the other heavy imports already loaded
+    workerPool = WorkerPool(preload=['algorithms.denoise', 'algorithms.detect_spots'])
+    tool.setWorkerPool(workerPool)
     tool.screen_center = app.screens()[len(app.screens())-1].availableGeometry().center()
     # spacing = QPoint((window.width() + video.width()) / 4 + 5, 0)
     qr = tool.frameGeometry()
@@ -507,4 +474,6 @@ if __name__ == "__main__":
     tool.move(qr.topLeft())
     tool.show()
     # Run the main Qt event loop, exiting the app when the event loop exits
-    sys.exit(app.exec_())
+    exitCode = app.exec_()
+    workerPool.close()
+    sys.exit(exitCode)
@@ -7,7 +7,7 @@ from qtpy.QtWidgets import QDialog, QDialogButtonBox
 from numpy import ndarray
 from imageCompareDialog_ui import Ui_ImageCompareDialog
 
-from algorithms.denoise import ProcessStepDenoiseConcurrent
+from algorithms.denoise import ProcessStepDenoiseConcurrent, ProcessStepDenoise3DConcurrent
 from algorithms.threshold_mask import ProcessStepThresholdMask
 from processing import ProcessStep, ProcessStatus
 from typing import Callable, Dict
@@ -65,8 +65,13 @@ class ProcessStepVisualizeDenoise(ProcessStep):
 
     def run(self, progressCallback: Callable[[int, str], None] = None):
         self._status = ProcessStatus.RUNNING
-        step = ProcessStepDenoiseConcurrent(self._params)
+        if self._params.get('use_denoise3d', False):
+            step = ProcessStepDenoise3DConcurrent(self._params)
+        else:
+            step = ProcessStepDenoiseConcurrent(self._params)
         step.setApp(self._app)
+        step.setLogger(self._logger)
+        step.setWorkerPool(self._workerPool)
         step.setInputs(self._inputs)
         step.run(progressCallback)
         stepOutputs = step.stepOutputs()
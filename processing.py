@@ -1,11 +1,24 @@
 # processing.py
 from qtpy.QtWidgets import QApplication
-from typing import List, Dict, Tuple, Callable
+from typing import List, Dict, NamedTuple, Tuple, Callable
 from enum import Enum
+from importlib import import_module
 import multiprocessing as mp
-from queue import Full
+from multiprocessing import shared_memory
+import numpy as np
+from queue import Empty, Full, SimpleQueue
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+import threading
 import logging
+import os
 from os import getpid
+from time import perf_counter
+from sysresources import availableCpus, defaultMemoryBudget
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
 
 class ProcessStatus(Enum):
     NOT_STARTED = 0     # the processing step has not started
@@ -38,13 +51,31 @@ class ProcessStep():
         self._endOutputs: List = []
         self._params: Dict = params
         self._logger = None
+        self._workerPool = None
+        self._partialOutputCallback = None
 
     def setApp(self, app: QApplication):
         self._app = app
 
+    def setPartialOutputCallback(self, callback: Callable[[int, object], None]) -> None:
+        """
+        Set a callback that a step whose stepOutputs are independent items may call,
+        on any thread, with (index, item) as soon as that item is final, before the
+        step finishes.  A ProcessStepGraph uses this to start the steps that need
+        only that item early.  Steps are free to ignore it.
+        """
+        self._partialOutputCallback = callback
+
     def setLogger(self, logger: logging.Logger):
         self._logger = logger
 
+    def setWorkerPool(self, workerPool: 'WorkerPool'):
+        """
+        Set the long-lived WorkerPool that concurrent steps run on.
+        Steps that contain other steps must pass it on to them.
+        """
+        self._workerPool = workerPool
+
     def stepName(self) -> str:
         return self._stepName
 
@@ -87,6 +118,224 @@ class ProcessStep():
         """
         raise NotImplementedError()
 
+    @classmethod
+    def outputLike(cls, input: np.ndarray, params: Dict) -> Tuple[Tuple, np.dtype]:
+        """
+        Return the (shape, dtype) of the single ndarray step output this step produces
+        for an ndarray input, so that ProcessStepConcurrent can have its workers write
+        the outputs straight into shared memory.
+
+        The default of None means the outputs are sent back through the queue instead.
+        """
+        return None
+
+    @classmethod
+    def taskMemory(cls, input, params: Dict) -> int:
+        """
+        Estimate the peak memory in bytes that a worker needs to run this step on
+        one input, besides the input and output themselves, so that
+        ProcessStepConcurrent can limit how many run at once to fit its memory budget.
+
+        The default allows for a few float64 working copies of an ndarray input,
+        and 0, meaning no limit, for anything else.
+        """
+        if not isinstance(input, np.ndarray):
+            return 0
+        return 4 * input.size * 8
+
+class SharedArrayDescriptor(NamedTuple):
+    """
+    Where to find one array in a SharedArrayBlock
+    """
+    name: str
+    offset: int
+    shape: Tuple
+    dtype: str
+
+class SharedArrayBlock():
+    """
+    One block of shared memory holding a list of arrays.
+
+    Worker processes attach to the arrays through small descriptors,
+    (block name, offset, shape, dtype), so the array data itself is never
+    pickled or sent through a queue.  The creating process must call close()
+    once it no longer uses any of the arrays.
+    """
+
+    alignment = 64
+
+    def __init__(self, specs: List[Tuple[Tuple, np.dtype]]):
+        self.descriptors = []
+        size = 0
+        for shape, dtype in specs:
+            dtype = np.dtype(dtype)
+            self.descriptors.append((None, size, tuple(shape), dtype.str))
+            nBytes = int(np.prod(shape)) * dtype.itemsize
+            size += (nBytes + self.alignment - 1) // self.alignment * self.alignment
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, size))
+        self.descriptors = [SharedArrayDescriptor(self._shm.name, offset, shape, dtype)
+                            for _, offset, shape, dtype in self.descriptors]
+
+    @staticmethod
+    def view(shm: shared_memory.SharedMemory, descriptor: SharedArrayDescriptor) -> np.ndarray:
+        return np.ndarray(descriptor.shape, dtype=descriptor.dtype, buffer=shm.buf, offset=descriptor.offset)
+
+    def array(self, idx: int) -> np.ndarray:
+        return self.view(self._shm, self.descriptors[idx])
+
+    def close(self) -> None:
+        self._shm.close()
+        self._shm.unlink()
+
+def attachSharedArray(descriptor: SharedArrayDescriptor, attached: Dict) -> np.ndarray:
+    """
+    Return the array described by a SharedArrayBlock descriptor, attaching to
+    its block if this process hasn't already.  attached caches the blocks by name.
+    """
+    if descriptor.name not in attached:
+        attached[descriptor.name] = shared_memory.SharedMemory(name=descriptor.name)
+    return SharedArrayBlock.view(attached[descriptor.name], descriptor)
+
+def detachSharedArrays(attached: Dict) -> None:
+    """
+    Close the blocks attached by attachSharedArray().  Arrays from them must no longer be in use.
+    """
+    for shm in attached.values():
+        try:
+            shm.close()
+        except BufferError:
+            # a view is still alive somewhere; the mapping goes away with the process
+            pass
+    attached.clear()
+
+def preloadModules(moduleNames: List[str]) -> None:
+    """
+    WorkerPool initializer: import the named modules when each worker starts,
+    so that their import cost is paid once rather than in the first task.
+    A module that fails to import is skipped: a worker whose initializer raises
+    is restarted by the pool, over and over.
+    """
+    for name in moduleNames:
+        try:
+            import_module(name)
+        except ImportError as e:
+            mp.get_logger().warning(f"Worker {getpid()} could not preload {name}: {e}")
+
+# The variables that limit the threads of the native libraries used by the steps:
+# OpenBLAS (used by numpy and the BM4D library), OpenMP (scipy and scikit-image),
+# MKL, Apple's Accelerate and numexpr
+nativeThreadVariables = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                         "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+def initWorker(moduleNames: List[str], threads: int) -> None:
+    """
+    WorkerPool initializer: limit the worker's native libraries to threads threads
+    each, then preload the named modules.
+
+    The libraries read their limits from the environment when they load, so the
+    environment variables only affect those loaded from here on; WorkerPool also
+    starts its workers with them set.  If threadpoolctl is installed, it limits the
+    libraries already loaded too, as in workers that were forked rather than spawned.
+    """
+    os.environ.update({name: str(threads) for name in nativeThreadVariables})
+    if threadpool_limits is not None:
+        threadpool_limits(limits=threads)
+    preloadModules(moduleNames)
+
+class WorkerPool():
+    """
+    A long-lived pool of worker processes, and the Manager that serves the queues
+    between them, shared by every ProcessStepConcurrent that is given it.
+
+    With the spawn start method each new worker re-imports Qt, scikit-image and the
+    BM4D library, so the application creates one WorkerPool for the whole session,
+    naming the modules to preload in preload, and calls close() when it exits.
+
+    memoryBudget is the bytes of memory the tasks running on the workers may use
+    between them.  If it is None, each ProcessStepConcurrent uses defaultMemoryBudget()
+    as it starts.
+
+    threadsPerWorker limits the threads that each worker's BLAS and OpenMP libraries
+    start.  Left to themselves, each starts one per core in every worker, and the
+    workers fight over the cores.  The default shares the available CPUs out between
+    the workers that run tasks, so that processes x threadsPerWorker about fills them.
+
+    ProcessStepConcurrent steps running at the same time on different threads, as in a
+    ProcessStepGraph, take turns with the pool by holding lock: each uses all but one of
+    the processes, and their accumulators could otherwise leave no process for the workers.
+    """
+
+    def __init__(self, processes: int = None, preload: List[str] = [], memoryBudget: int = None,
+                 threadsPerWorker: int = None):
+        if processes is None:
+            # Use up to 3/4 of the available cores, and at least two so that
+            # accumulateOutputs can run alongside runInner
+            processes = max(2, int(availableCpus() * 3 / 4))
+        assert processes >= 2
+        if threadsPerWorker is None:
+            # one process mostly waits in accumulateOutputs
+            threadsPerWorker = max(1, availableCpus() // (processes - 1))
+        assert threadsPerWorker >= 1
+        self.processes = processes
+        self.memoryBudget = memoryBudget
+        self.threadsPerWorker = threadsPerWorker
+        # a spawned worker loads numpy, and its BLAS library, before the initializer runs,
+        # so start the workers with the limits already in their environment
+        savedEnvironment = {name: os.environ.get(name) for name in nativeThreadVariables}
+        os.environ.update({name: str(threadsPerWorker) for name in nativeThreadVariables})
+        try:
+            self.pool = mp.Pool(processes=processes, initializer=initWorker,
+                                initargs=(list(preload), threadsPerWorker))
+        finally:
+            for name, value in savedEnvironment.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+        self.manager = mp.Manager()
+        self.lock = threading.Lock()
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+        self.manager.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ProgressReporter():
+    """
+    Turns counts of completed tasks into progressCallback updates, with the
+    completed/total count, the throughput and the estimated time remaining
+    appended to the step name.  Updates are sent at most every minInterval
+    seconds, apart from the final one, so that a step with many quick tasks
+    can't flood Qt with signals.
+    """
+
+    def __init__(self, progressCallback: Callable[[int, str], None], stepName: str, total: int,
+                 minInterval: float = 0.5):
+        self._progressCallback = progressCallback
+        self._stepName = stepName
+        self._total = total
+        self._minInterval = minInterval
+        self._start = perf_counter()
+        self._lastReport = None
+
+    def update(self, completed: int) -> None:
+        now = perf_counter()
+        if completed < self._total and self._lastReport is not None and \
+                now - self._lastReport < self._minInterval:
+            return
+        self._lastReport = now
+        rate = completed / max(now - self._start, 1e-9)
+        eta = f"{(self._total - completed) / rate:.0f}s" if rate > 0 else "unknown"
+        self._progressCallback(
+            int(100 * completed / self._total),
+            f"{self._stepName} {completed}/{self._total} tasks, {rate:.2f} tasks/s, ETA {eta}")
+
 class ProcessStepSequence(ProcessStep):
     """
     This is a composite processing step that encapsulates
@@ -106,7 +355,7 @@ class ProcessStepSequence(ProcessStep):
         # Account for process steps already completed when reporting progress
         if self._progressCallback:
             self._progressCallback(
-                int((self._stepsCompleted + progress / 100.) / len(self._steps)),
+                int(100 * (self._stepsCompleted + progress / 100.) / len(self._steps)),
                 self.baseStepName + '.' + stepName)
 
     def run(self, progressCallback: Callable[[int, str], None] = None) -> None:
@@ -117,6 +366,7 @@ class ProcessStepSequence(ProcessStep):
         for onStep, step in enumerate(self._steps):
             step.setApp(self._app)
             step.setLogger(self._logger)
+            step.setWorkerPool(self._workerPool)
             self._stepName = f"{self.baseStepName}.{step.stepName()}"
             step.setInput(stepData)
             step.run(self.progressCallbackWrapper if progressCallback else None)
@@ -129,7 +379,173 @@ class ProcessStepSequence(ProcessStep):
         self._stepOutputs = stepData
         self._status = status
         self._stepName = self.baseStepName
-        progressCallback(100, self._stepName)
+        if progressCallback:
+            progressCallback(100, self._stepName)
+
+class ProcessNode(NamedTuple):
+    """
+    One step of a ProcessStepGraph: the names of the values whose items, in order,
+    make up the step's inputs, and the names its stepOutputs are stored under.
+    """
+    name: str
+    step: ProcessStep
+    inputs: List[str]
+    outputs: List[str]
+
+def bindValues(names: List[str], items: List) -> Dict[str, List]:
+    """
+    Name the items of a list of inputs or outputs for a ProcessStepGraph.  A single
+    name names the whole list; otherwise there must be a name for each item, which
+    names a list of just that item.  With no names, the items aren't needed.
+    """
+    if len(names) == 0:
+        return {}
+    if len(names) == 1:
+        return {names[0]: list(items)}
+    assert len(names) == len(items)
+    return {name: [item] for name, item in zip(names, items)}
+
+class ProcessStepGraph(ProcessStep):
+    """
+    This is a composite processing step that runs a graph of processing steps.
+
+    Rather than each step taking the stepOutputs of the one before, as in a
+    ProcessStepSequence, each ProcessNode names the values the step takes and
+    produces.  A step starts as soon as all of its inputs are ready, so independent
+    branches run at the same time, and the whole graph takes as long as its longest
+    chain of steps.  When a step's outputs are named one per item, the steps that
+    need only some of them can start as soon as the step passes those on through
+    its partial output callback.
+
+    inputNames names the inputs given to setInputs(), and outputNames the values
+    that make up stepOutputs, as bindValues() describes.  endOutputs is a dict of
+    each step's endOutputs, by node name.
+
+    The steps run on threads, so they aren't given the app: Qt events can only be
+    processed on the main thread, which the graph does while it waits for them.
+    If the graph isn't given a WorkerPool, it starts one for the steps to share.
+    """
+
+    def __init__(self, nodes: List[ProcessNode], inputNames: List[str], outputNames: List[str],
+                 params: Dict = {}):
+        super().__init__(params)
+        self._nodes = nodes
+        self._inputNames = inputNames
+        self._outputNames = outputNames
+        self._stepName = "Graph"
+        self._progressCallback = None
+        self._nodeProgress: Dict[str, int] = {}
+        self._partialOutputs = SimpleQueue()
+        self.checkGraph()
+
+    def checkGraph(self) -> None:
+        """
+        Raise ValueError unless every value is produced once, every input a step
+        names is produced, and there are no cycles.
+        """
+        if len(set(node.name for node in self._nodes)) < len(self._nodes):
+            raise ValueError("Process nodes must have different names")
+        producedBy = {name: None for name in self._inputNames}
+        for node in self._nodes:
+            for name in node.outputs:
+                if name in producedBy:
+                    raise ValueError(f"Value {name} is produced more than once")
+                producedBy[name] = node.name
+        ready = set(self._inputNames)
+        unordered = list(self._nodes)
+        while unordered:
+            runnable = [node for node in unordered if all(name in ready for name in node.inputs)]
+            if not runnable:
+                missing = [name for node in unordered for name in node.inputs if name not in producedBy]
+                raise ValueError(f"Values {missing} are never produced" if missing else
+                                 f"Nodes {[node.name for node in unordered]} depend on each other")
+            for node in runnable:
+                ready.update(node.outputs)
+                unordered.remove(node)
+        missing = [name for name in self._outputNames if name not in producedBy]
+        if missing:
+            raise ValueError(f"Outputs {missing} are never produced")
+
+    def progressCallbackWrapper(self, nodeName: str, progress: int, stepName: str) -> None:
+        # report the average progress of all the steps, since several run at once
+        self._nodeProgress[nodeName] = progress
+        if self._progressCallback:
+            self._progressCallback(
+                int(sum(self._nodeProgress.values()) / len(self._nodes)),
+                self._stepName + '.' + stepName)
+
+    def partialOutput(self, node: ProcessNode, index: int, item) -> None:
+        # called on the node's thread; the values are only touched on the graph's
+        self._partialOutputs.put((node, index, item))
+
+    def runNode(self, node: ProcessNode, inputs: List) -> None:
+        """
+        Run one step, on one of the graph's threads
+        """
+        step = node.step
+        step.setApp(None)
+        step.setLogger(self._logger)
+        step.setWorkerPool(self._workerPool)
+        # outputs named one per item can be passed on as each is ready
+        step.setPartialOutputCallback(partial(self.partialOutput, node) if len(node.outputs) > 1 else None)
+        step.setInputs(inputs)
+        step.run(partial(self.progressCallbackWrapper, node.name) if self._progressCallback else None)
+
+    def run(self, progressCallback: Callable[[int, str], None] = None) -> None:
+        if self._workerPool is None:
+            # Give all the steps one pool, rather than have each concurrent step start its
+            # own, from its own thread, each setting the thread limits in os.environ
+            with WorkerPool() as workerPool:
+                self._workerPool = workerPool
+                try:
+                    self.runNodes(progressCallback)
+                finally:
+                    self._workerPool = None
+        else:
+            self.runNodes(progressCallback)
+
+    def runNodes(self, progressCallback: Callable[[int, str], None] = None) -> None:
+        self._progressCallback = progressCallback
+        self._nodeProgress = {node.name: 0 for node in self._nodes}
+        self._stepOutputs = []
+        self._endOutputs = {}
+        self._status = ProcessStatus.RUNNING
+        status = ProcessStatus.COMPLETED
+        values = bindValues(self._inputNames, self._inputs)
+        pending = list(self._nodes)
+        running = {}
+        self._partialOutputs = SimpleQueue()
+        with ThreadPoolExecutor(max_workers=max(1, len(self._nodes))) as executor:
+            while running or (pending and status == ProcessStatus.COMPLETED):
+                # take the items that running steps have finished early
+                while not self._partialOutputs.empty():
+                    node, index, item = self._partialOutputs.get()
+                    values[node.outputs[index]] = [item]
+                # start every step whose inputs are ready, in the order given
+                for node in [node for node in pending if all(name in values for name in node.inputs)]:
+                    pending.remove(node)
+                    inputs = [item for name in node.inputs for item in values[name]]
+                    running[executor.submit(self.runNode, node, inputs)] = node
+                done, _ = wait(running, timeout=0.1, return_when=FIRST_COMPLETED)
+                if self._app:
+                    self._app.processEvents()
+                for future in done:
+                    node = running.pop(future)
+                    future.result()
+                    if node.step.status() != ProcessStatus.COMPLETED:
+                        # let the running steps finish, but start no more
+                        if status == ProcessStatus.COMPLETED:
+                            status = node.step.status()
+                        continue
+                    values.update(bindValues(node.outputs, node.step.stepOutputs()))
+                    self._endOutputs[node.name] = node.step.endOutputs()
+                    self._nodeProgress[node.name] = 100
+        self._status = status
+        if status != ProcessStatus.COMPLETED:
+            return
+        self._stepOutputs = [item for name in self._outputNames for item in values[name]]
+        if progressCallback:
+            progressCallback(100, self._stepName)
 
 class ProcessStepConcurrent(ProcessStep):
     """
@@ -137,53 +553,107 @@ class ProcessStepConcurrent(ProcessStep):
     be run in parallel.
 
     params, if supplied, can be either a dict or a list of dicts
+
+    taskParams, if supplied, is a list with a params dict for each input, which is
+    set on the worker's step before that input is run.  This lets inputs that need
+    different params, such as the slices of several channels, share one run.
+
+    While it runs, progressCallback is sent the number of tasks completed, the
+    throughput and the estimated time remaining, at most every progressInterval seconds.
+
+    No more tasks run at once than fit in the memory budget, by the step's taskMemory()
+    estimate for the largest input.
+
+    assemble, if supplied, is called with the list of outputs, and what it returns
+    replaces the list in stepOutputs.  Outputs written to shared memory are passed to it
+    as views of the shared block, so it must copy whatever it keeps, but they are then
+    copied only once, into whatever it builds from them.
+
+    taskDone, if supplied, is called on the thread running the step with the index of
+    each task as it completes, and its output as a view of the shared block, or None
+    if the outputs aren't written to shared memory.  It must copy whatever it keeps.
     """
 
-    def __init__(self, step: ProcessStep, params = {}):
+    progressInterval = 0.5
+
+    def __init__(self, step: ProcessStep, params = {}, taskParams: List[Dict] = None,
+                 assemble: Callable[[List], object] = None, taskDone: Callable[[int, object], None] = None):
         assert isinstance(params, (dict, list))
         super().__init__(params)
         self._stepName = "Concurrent"
         self._step = step
+        self._taskParams = taskParams
+        self._assemble = assemble
+        self._taskDone = taskDone
+        self._tasksCompleted = 0
 
     def setInputs(self, inputs: List) -> None:
         super().setInputs(inputs)
         self._stepOutputs = []
         self._endOutputs = []
 
-    def setApp(self, app: QApplication):
-        # QApplication objects can't be pickled, so don't store it
-        pass
-
-    def runInner(self, stepClass: ProcessStep, params: Dict, inQ: mp.Queue, outQ: mp.Queue) -> None:
+    @staticmethod
+    def runInner(stepClass: ProcessStep, params: Dict, logger: logging.Logger, inQ: mp.Queue, outQ: mp.Queue) -> None:
         """
         Pull the inputs off the input queue and call the processStep's run() function
         Get the outputs and push them on the output queue as a tuple, along with the
         index from the input queue, so that we can keep the results in the same order
         as the inputs, even though the parallel processes may finish in a different order.
+
+        This and accumulateOutputs() are static, so that starting a worker sends it only
+        the step class, params, logger and queues, and not the ProcessStepConcurrent
+        with all of its inputs.
+
+        A task that raises is sent back as (index, None, None, error message), and the
+        worker goes on to the next, so that every input is taken off the queue and every
+        worker passes on its poison pill, whatever fails.
         """
+        step = None
+        attached = {}
         try:
-            step = stepClass(params)
-            step.setLogger(self._logger)
             while True:
-                idx, inputs = inQ.get()
+                idx, inputs, outputDescriptor, taskParams = inQ.get()
                 if idx < 0:
-                    # pass the "poison pill" on and then exit
-                    outQ.put((idx, None))
                     break
-                step.setInputs(inputs)
-                step.run()
-                outQ.put((idx, step.stepOutputs(), step.endOutputs()))
-        except Exception as e:
-            self._logger.exception(f"Worker {getpid()} got exception {e}")
-
-    def accumulateOutputs(self, nWorkers: int, outQ: mp.Queue) -> None:
+                try:
+                    if step is None:
+                        step = stepClass(params)
+                        step.setLogger(logger)
+                    if taskParams is not None:
+                        step.setParams(taskParams)
+                    # ndarray inputs arrive as descriptors of arrays in shared memory
+                    step.setInputs([attachSharedArray(input, attached) if isinstance(input, SharedArrayDescriptor)
+                                    else input for input in inputs])
+                    step.run()
+                    if outputDescriptor is not None:
+                        # write the output straight into shared memory rather than sending it back
+                        attachSharedArray(outputDescriptor, attached)[...] = step.stepOutputs()[0]
+                        outQ.put((idx, [None], step.endOutputs()))
+                    else:
+                        outQ.put((idx, step.stepOutputs(), step.endOutputs()))
+                except Exception as e:
+                    logger.exception(f"Worker {getpid()} got exception {e} on idx {idx}")
+                    outQ.put((idx, None, None, f"{type(e).__name__}: {e}"))
+        finally:
+            if step is not None:
+                step.setInputs([])
+            detachSharedArrays(attached)
+            # pass the "poison pill" on and then exit
+            outQ.put((-1, None))
+
+    @staticmethod
+    def accumulateOutputs(nWorkers: int, logger: logging.Logger, outQ: mp.Queue, progressQ: mp.Queue) -> Tuple:
         """
         Accumulate the results from the various parallel threads and accumulate them.
         This should be the last step of the pipeline
         We shut down when we've received notice that all the workers have shut down
         i.e. we received the same number of poison pills as workers
+        If progressQ isn't None, the index of each output is put on it as it is received.
+        Returns the stepOutputs, the endOutputs and a list of (index, error message)
+        for the tasks that failed, in which case the outputs are incomplete.
         """
         unorderedOutputs = []
+        failures = []
         workersDone = 0
         try:
             while workersDone < nWorkers:
@@ -191,96 +661,217 @@ class ProcessStepConcurrent(ProcessStep):
                 idx = outputs[0]
                 if idx < 0:
                     workersDone += 1
-                    self._logger.info(f"{workersDone} workers done so far")
+                    logger.info(f"{workersDone} workers done so far")
+                    continue
+                if len(outputs) > 3:
+                    failures.append((idx, outputs[3]))
                     continue
                 unorderedOutputs.append(outputs)
-                self._logger.info(f"Appended idx {idx} to outputs")
+                logger.info(f"Appended idx {idx} to outputs")
+                if progressQ is not None:
+                    progressQ.put(idx)
             unorderedOutputs.sort(key=lambda item: item[0])
             # remove the indices and unwrap each slice before outputting
             # create a tuple of stepOutputs and endOutputs
             return \
                 [item[1][0] for item in unorderedOutputs], \
-                [item[2][0] for item in unorderedOutputs]
+                [item[2][0] for item in unorderedOutputs], \
+                sorted(failures)
         except Exception as e:
-            self._logger.exception(f"accumulateOutputs got exception {e}")
+            logger.exception(f"accumulateOutputs got exception {e}")
+            raise
+
+    def createSharedBlocks(self) -> Tuple[SharedArrayBlock, SharedArrayBlock]:
+        """
+        If all the inputs are ndarrays, copy them into a shared memory block, so that only
+        their descriptors go through the input queue.  If the step also declares the shape
+        of its outputs, allocate a shared memory block for the workers to write them into.
+        Returns (input block, output block), either of which may be None.
+        """
+        if len(self._inputs) == 0 or not all(isinstance(input, np.ndarray) for input in self._inputs):
+            return None, None
+        inBlock = SharedArrayBlock([(input.shape, input.dtype) for input in self._inputs])
+        for idx, input in enumerate(self._inputs):
+            inBlock.array(idx)[...] = input
+        params = self._params if isinstance(self._params, dict) else self._params[0]
+        outputSpecs = [self._step.outputLike(input, self._taskParams[idx] if self._taskParams else params)
+                       for idx, input in enumerate(self._inputs)]
+        outBlock = SharedArrayBlock(outputSpecs) if all(outputSpecs) else None
+        return inBlock, outBlock
+
+    def fitWorkers(self, nWorkers: int, memoryBudget: int) -> int:
+        """
+        Return how many of nWorkers can run tasks at once without their estimated
+        memory use exceeding memoryBudget, but at least one.
+        """
+        params = self._params if isinstance(self._params, dict) else self._params[0]
+        taskMemory = max([self._step.taskMemory(input, self._taskParams[idx] if self._taskParams else params)
+                          for idx, input in enumerate(self._inputs)], default=0)
+        if memoryBudget is None or taskMemory == 0:
+            return nWorkers
+        fitting = max(1, min(nWorkers, memoryBudget // taskMemory))
+        if fitting < nWorkers:
+            self._logger.info(f"Running {fitting} tasks at once rather than {nWorkers}, to fit "
+                              f"{taskMemory / 1024**2:.0f}MB per task in {memoryBudget / 1024**2:.0f}MB")
+        return fitting
+
+    def idle(self, progressQ: mp.Queue, reporter: ProgressReporter, outBlock: SharedArrayBlock) -> None:
+        """
+        Called while waiting on the workers.  Let Qt process UI events, pass on the
+        tasks completed since the last call to taskDone, and their count to the reporter.
+        """
+        if self._app:
+            self._app.processEvents()
+        if progressQ is None:
+            return
+        completed = []
+        try:
+            while True:
+                completed.append(progressQ.get_nowait())
+        except Empty:
+            pass
+        for idx in completed:
+            self._tasksCompleted += 1
+            if self._taskDone:
+                self._taskDone(idx, outBlock.array(idx) if outBlock else None)
+        if completed and reporter:
+            reporter.update(self._tasksCompleted)
+
+    def runPool(self, workerPool: WorkerPool, nWorkers: int, inBlock: SharedArrayBlock, outBlock: SharedArrayBlock,
+                progressCallback: Callable[[int, str], None] = None) -> bool:
+        """
+        Start nWorkers workers and the accumulator on the pool, feed the inputs to the
+        workers and collect the outputs in order.  The pool must have at least nWorkers+1
+        processes, and is left running for later steps.
+        Returns False, leaving the outputs empty, if any task failed.
+        """
+        pool = workerPool.pool
+        mgr = workerPool.manager
+        inQ = mgr.Queue(nWorkers)   # one per worker
+        outQ = mgr.Queue(nWorkers)  # contains tuple(stepOutputs, endOutputs) to avoid race with two queues
+        # the indices of completed tasks from the accumulator, only needed if someone is listening
+        progressQ = mgr.Queue() if progressCallback or self._taskDone else None
+        self._tasksCompleted = 0
+        reporter = ProgressReporter(progressCallback, self._stepName, len(self._inputs),
+                                    self.progressInterval) if progressCallback else None
+        self._logger.info("Queues created")
+        if isinstance(self._params, dict):
+            self._params = [self._params] * nWorkers
+        assert len(self._params) >= nWorkers    # check in case params was passed in as a list
+        accumulatorResults = pool.apply_async(ProcessStepConcurrent.accumulateOutputs,
+                                             (nWorkers, self._logger, outQ, progressQ))
+        self._logger.info("Started accumulateOutputs Worker")
+        workerResults = []
+        try:
+            workerResults = [pool.apply_async(ProcessStepConcurrent.runInner,
+                                              (self._step, self._params[i], self._logger, inQ, outQ))
+                             for i in range(nWorkers)]
+        except Exception as e:
+            self._logger.exception(f"Exception trying to start workers with runInner: {e}")
+        self._logger.info(f"Started {nWorkers} Workers with runInner")
+
+        for idx, inputs in enumerate(self._inputs):
+            self._logger.info(f"Enqueued idx {idx}")
+            while True:
+                # the queue can fill, at which point inQ.put will block
+                # Set a timeout so that Qt can handle UI events before trying again
+                try:
+                    inQ.put((idx,
+                             [inBlock.descriptors[idx] if inBlock else inputs],
+                             outBlock.descriptors[idx] if outBlock else None,
+                             self._taskParams[idx] if self._taskParams else None),
+                            timeout=0.1)
+                    break
+                except Full:
+                    self.idle(progressQ, reporter, outBlock)
+
+        for idx in range(nWorkers):
+            self._logger.info(f"Enqueuing poison pill #{idx}")
+            while True:
+                # Let Qt handle UI events, same as above
+                try:
+                    inQ.put((-1, None, None, None), timeout=0.1)
+                    break
+                except Full:
+                    self.idle(progressQ, reporter, outBlock)
+
+        # wait for everything to finish
+        while True:
+            try:
+                stepOutputs, endOutputs, failures = accumulatorResults.get(0.1)
+                self._logger.info("Got output from accumulateOutputs")
+                break
+            except mp.TimeoutError:
+                # let Qt get in to process UI events, and report progress
+                self.idle(progressQ, reporter, outBlock)
+        # pass on the last tasks completed
+        self.idle(progressQ, reporter, outBlock)
+        # the workers have all passed on their poison pills, so they are returning
+        for result in workerResults:
+            result.wait()
+        self._logger.info("Workers finished")
+        if failures:
+            for idx, message in failures:
+                self._logger.error(f"{self._step.__name__} failed on input {idx}: {message}")
+            return False
+        if outBlock:
+            # the workers wrote their outputs into shared memory, which is
+            # released when the step finishes
+            stepOutputs = [outBlock.array(idx) for idx in range(len(self._inputs))]
+            if self._assemble is None:
+                stepOutputs = [output.copy() for output in stepOutputs]
+        if self._assemble is not None:
+            stepOutputs = self._assemble(stepOutputs)
+        self._stepOutputs.append(stepOutputs)
+        self._endOutputs.append(endOutputs)
+        return True
 
     def run(self, progressCallback: Callable[[int, str], None] = None) -> None:
         """
         Run the steps concurrently, accumulating the results in a list
-
-        Doesn't yet support progressCallback updates
         """
+        assert self._taskParams is None or len(self._taskParams) == len(self._inputs)
         self._status = ProcessStatus.RUNNING
         self._stepOutputs = []
         self._endOutputs = []
-        nCores = mp.cpu_count()
-        # We need at least two so that accumulateOutputs can run alongside runInner
-        # Use up to 3/4 of the available cores, but no need for more than we have work.
-        coresToUse = min(max(2, int(nCores * 3 / 4)), len(self._inputs) + 1)
-        nWorkers = coresToUse - 1
-        self._logger.info(f"Using {coresToUse} cores")
-        with mp.Pool(processes=coresToUse) as pool:
-            with mp.Manager() as mgr:
-                inQ = mgr.Queue(nWorkers)   # one per worker
-                outQ = mgr.Queue(nWorkers)  # contains tuple(stepOutputs, endOutputs) to avoid race with two queues
-                self._logger.info("Queues created")
-                if isinstance(self._params, dict):
-                    self._params = [self._params] * nWorkers
-                assert len(self._params) >= nWorkers    # check in case params was passed in as a list
-                accumulatorResults = pool.apply_async(self.accumulateOutputs, (nWorkers, outQ))
-                self._logger.info("Started accumulateOutputs Worker")
-                try:
-                    workerResults = [pool.apply_async(self.runInner, (self._step, self._params[i], inQ, outQ)) for i in range(nWorkers)]
-                except Exception as e:
-                    self._logger.exception(f"Exception trying to start workers with runInner: {e}")
-                self._logger.info(f"Started {nWorkers} Workers with runInner")
-
-                for idx, inputs in enumerate(self._inputs):
-                    self._logger.info(f"Enqueued idx {idx}")
-                    while True:
-                        # the queue can fill, at which point inQ.put will block
-                        # Set a timeout so that Qt can handle UI events before trying again
-                        try:
-                            inQ.put((idx, [inputs]), timeout=0.1)
-                            break
-                        except Full:
-                            if self._app:
-                                self._app.processEvents()
-
-                for idx in range(nWorkers):
-                    self._logger.info(f"Enqueuing poison pill #{idx}")
-                    while True:
-                        # Let Qt handle UI events, same as above
-                        try:
-                            inQ.put((-1, None), timeout=0.1)
-                            break
-                        except Full:
-                            if self._app:
-                                self._app.processEvents()
-
-                # close the pool's input and wait for everything to finish
-                pool.close()
-                self._logger.info("Pool closed")
-                while True:
-                    try:
-                        stepOutputs, endOutputs = accumulatorResults.get(0.1)
-                        self._logger.info("Got output from accumulateOutputs")
-                        break
-                    except mp.TimeoutError:
-                        # let Qt get in to process UI events.
-                        if self._app:
-                            self._app.processEvents()
-                pool.join()
-                self._logger.info("Pool joined")
-                self._stepOutputs.append(stepOutputs)
-                self._endOutputs.append(endOutputs)
-            if progressCallback:
-                #TODO: provide a callback mechanism that passes on updates
-                # from accumulateOutputs
-                progressCallback(100, self._stepName)
-            if self._app:
-                self._app.processEvents()
-            self._status = ProcessStatus.COMPLETED
+        inBlock, outBlock = self.createSharedBlocks()
+        try:
+            if self._workerPool:
+                with self._workerPool.lock:
+                    # no need for more workers than we have work, or than fit in memory
+                    nWorkers = min(self._workerPool.processes - 1, len(self._inputs))
+                    nWorkers = self.fitWorkers(nWorkers, self._workerPool.memoryBudget or defaultMemoryBudget())
+                    self._logger.info(f"Using {nWorkers + 1} of {self._workerPool.processes} pool processes")
+                    completed = self.runPool(self._workerPool, nWorkers, inBlock, outBlock, progressCallback)
+            else:
+                # No long-lived pool was given, so start one just for this step.
+                # We need at least two so that accumulateOutputs can run alongside runInner
+                # Use up to 3/4 of the available cores, but no need for more than we have work,
+                # or than fit in memory.
+                nCores = availableCpus()
+                coresToUse = min(max(2, int(nCores * 3 / 4)), len(self._inputs) + 1)
+                coresToUse = self.fitWorkers(coresToUse - 1, defaultMemoryBudget()) + 1
+                self._logger.info(f"Using {coresToUse} cores")
+                with WorkerPool(coresToUse) as workerPool:
+                    completed = self.runPool(workerPool, coresToUse - 1, inBlock, outBlock, progressCallback)
+        except Exception as e:
+            self._logger.exception(f"{self._stepName} got exception {e}")
+            completed = False
+        finally:
+            # the outputs have been copied out of shared memory by now
+            for block in (inBlock, outBlock):
+                if block:
+                    block.close()
+        if not completed:
+            self._stepOutputs = []
+            self._endOutputs = []
+            self._status = ProcessStatus.ABORTED
+            return
+        if progressCallback:
+            progressCallback(100, self._stepName)
+        if self._app:
+            self._app.processEvents()
+        self._status = ProcessStatus.COMPLETED
 
 class ProcessStepIterate(ProcessStep):
     """
@@ -303,7 +894,7 @@ class ProcessStepIterate(ProcessStep):
         # Account for process steps already completed when reporting progress
         if self._progressCallback:
             self._progressCallback(
-                int((self._stepsCompleted + progress / 100.) / len(self._inputs)),
+                int(100 * (self._stepsCompleted + progress / 100.) / len(self._inputs)),
                 self._stepName + '.' + stepName)
         if self._app:
             self._app.processEvents()
@@ -322,6 +913,7 @@ class ProcessStepIterate(ProcessStep):
             step = self._stepClass(self._paramsList[i])
             step.setApp(self._app)
             step.setLogger(self._logger)
+            step.setWorkerPool(self._workerPool)
             step.setInputs([input])
             step.run(self.progressCallbackWrapper if progressCallback else None)
             statuses[i] = step.status()
@@ -0,0 +1,97 @@
+# sysresources.py
+
+"""
+The CPUs and memory this process can use, allowing for the limits of the cgroup it
+runs in, as under docker, Kubernetes or SLURM.  This has no dependencies beyond the
+standard library, so that modules such as the confocal file reader can size their
+thread pools without importing the process step machinery and Qt.
+"""
+
+import multiprocessing as mp
+import os
+from typing import List
+
+cgroupRoot = "/sys/fs/cgroup"
+
+def readCgroupFile(fileNames: List[str]) -> str:
+    """
+    Return the contents of the first of the cgroup fileNames that can be read, or None.
+    Each name is looked for in this process's own cgroup v2 directory and then at the
+    cgroup root, which is where a process in a container sees its container's cgroup.
+    Names of cgroup v1 files include their controller directory, e.g. "memory/memory.stat".
+    """
+    ownPath = ""
+    try:
+        with open("/proc/self/cgroup", 'r') as f:
+            for line in f:
+                if line.startswith("0::"):
+                    ownPath = line[3:].strip().rstrip('/')
+    except OSError:
+        pass
+    for fileName in fileNames:
+        for dirName in dict.fromkeys([cgroupRoot + ownPath, cgroupRoot]):
+            try:
+                with open(f"{dirName}/{fileName}", 'r') as f:
+                    return f.read().strip()
+            except OSError:
+                continue
+    return None
+
+def availableCpus() -> int:
+    """
+    The number of CPUs this process can use: those it may be scheduled on,
+    limited by its cgroup's CPU quota, as set by docker --cpus or a Kubernetes limit.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on macOS
+        cpus = mp.cpu_count()
+    quota = None
+    cpuMax = readCgroupFile(["cpu.max"])
+    if cpuMax:
+        # cgroup v2: "<quota> <period>", or "max <period>" if unlimited
+        quota, period = cpuMax.split()[:2]
+        quota = None if quota == "max" else int(quota) / int(period)
+    else:
+        quotaUs = readCgroupFile(["cpu/cpu.cfs_quota_us", "cpu,cpuacct/cpu.cfs_quota_us"])
+        periodUs = readCgroupFile(["cpu/cpu.cfs_period_us", "cpu,cpuacct/cpu.cfs_period_us"])
+        if quotaUs and periodUs and int(quotaUs) > 0:
+            quota = int(quotaUs) / int(periodUs)
+    if quota:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+def availableMemory() -> int:
+    """
+    The bytes of memory this process can still use without swapping: MemAvailable,
+    limited by what is left under its cgroup's memory limit, not counting reclaimable
+    file cache.  None if neither can be found, as on macOS.
+    """
+    available = None
+    try:
+        with open("/proc/meminfo", 'r') as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    limit = readCgroupFile(["memory.max", "memory/memory.limit_in_bytes"])
+    usage = readCgroupFile(["memory.current", "memory/memory.usage_in_bytes"])
+    # cgroup v1 reports no limit as a huge number
+    if limit and usage and limit != "max" and int(limit) < 2**60:
+        inactiveFile = 0
+        for line in (readCgroupFile(["memory.stat", "memory/memory.stat"]) or "").splitlines():
+            key, value = line.split()[:2]
+            if key in ("inactive_file", "total_inactive_file"):
+                inactiveFile = int(value)
+        cgroupAvailable = max(0, int(limit) - int(usage) + inactiveFile)
+        available = cgroupAvailable if available is None else min(available, cgroupAvailable)
+    return available
+
+def defaultMemoryBudget() -> int:
+    """
+    3/4 of the memory available now, or None if that can't be found.
+    """
+    available = availableMemory()
+    return None if available is None else int(available * 3 / 4)